@@ -0,0 +1,94 @@
+"""
+跨连接合批：各连接提交的转录请求由一个合批协程凑成一批，交给线程池一次推理
+server.py 和 server_streaming.py 共用
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class BatchQueue:
+    """单个合批协程 + 线程池
+
+    第一个请求到达后最多再等 wait 秒，凑满 max_items（按 weight 计）就提前结束；
+    同一批按 key（如语言）分组，每组在线程池里调用一次 run_batch(items, key)，
+    返回与 items 一一对应的结果。提交后不等结果就去收集下一批，并发度由线程池决定；
+    workers 个批次都在推理时先不提交，新请求继续在队列里攒成更大的批。
+    """
+    def __init__(self, run_batch, executor, max_items, wait, workers, weight=None):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_items = max_items
+        self.wait = wait
+        self.weight = weight or (lambda item: 1)
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(workers)  # 正在推理的批次数不超过线程池容量
+        self.task = None
+
+    def start(self):
+        """启动合批协程（需在事件循环中调用）"""
+        self.task = asyncio.create_task(self._collect())
+
+    async def submit(self, item, key):
+        """提交一个请求，等这一批推理完返回它的结果"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, key, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            total = self.weight(batch[0][0])
+            deadline = loop.time() + self.wait
+            while total < self.max_items:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(entry)
+                total += self.weight(entry[0])
+
+            # 线程池满时在这里等，期间到达的请求补进这一批
+            await self.slots.acquire()
+            while total < self.max_items and not self.queue.empty():
+                entry = self.queue.get_nowait()
+                batch.append(entry)
+                total += self.weight(entry[0])
+
+            groups = {}
+            for item, key, future in batch:
+                groups.setdefault(key, []).append((item, future))
+
+            # 多组时其余组各占一个名额，保证同时推理的批次数不超过 workers
+            for i, (key, entries) in enumerate(groups.items()):
+                if i > 0:
+                    await self.slots.acquire()
+                self._dispatch(loop, key, entries)
+
+    def _dispatch(self, loop, key, entries):
+        """把一组请求提交到线程池，完成后回填各自的 future"""
+        if len(entries) > 1:
+            logger.info(f"📦 合批推理 {len(entries)} 条")
+        done = loop.run_in_executor(self.executor, self.run_batch, [item for item, _ in entries], key)
+        done.add_done_callback(lambda done: self._resolve(done, entries))
+
+    def _resolve(self, done, entries):
+        self.slots.release()
+        if done.cancelled():
+            for _, future in entries:
+                future.cancel()
+            return
+        try:
+            results = done.result()
+        except Exception as e:
+            for _, future in entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(entries, results):
+            if not future.done():  # 连接可能已经断开
+                future.set_result(result)
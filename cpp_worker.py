@@ -0,0 +1,62 @@
+"""
+server_cpp.py 的推理 worker 进程入口
+只依赖 numpy 和 pywhispercpp，worker 进程不加载 av、silero-vad（torch）、scipy 等主进程才用的库
+"""
+import sys
+import ctypes
+import logging
+from multiprocessing import shared_memory
+import numpy as np
+from pywhispercpp.model import Model
+
+logger = logging.getLogger(__name__)
+
+# macOS QoS：USER_INITIATED 的线程调度器优先放到 P 核
+QOS_CLASS_USER_INITIATED = 0x19
+
+# 每个 worker 进程持有一份模型
+MODEL = None
+
+def set_qos_user_initiated():
+    """macOS：把当前线程设为 USER_INITIATED，之后创建的推理线程继承该 QoS"""
+    if sys.platform != "darwin":
+        return
+    try:
+        libsystem = ctypes.CDLL("libSystem.dylib")
+        libsystem.pthread_set_qos_class_self_np(QOS_CLASS_USER_INITIATED, 0)
+    except (OSError, AttributeError) as e:
+        logger.warning(f"设置 QoS 失败: {e}")
+
+def init_worker(model_path: str, n_threads: int):
+    """worker 进程初始化：每个进程加载一份模型"""
+    global MODEL
+    # 任务在 worker 主线程上执行，whisper.cpp 的计算线程也由它创建
+    set_qos_user_initiated()
+    MODEL = Model(model_path, n_threads=n_threads)
+
+def worker_ready(_):
+    """空任务，用于启动时拉起 worker"""
+    return MODEL is not None
+
+def worker_transcribe(shm_name: str, num_samples: int) -> str:
+    """从共享内存读取 PCM 并转录"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        audio = np.ndarray((num_samples,), dtype=np.float32, buffer=shm.buf)
+        try:
+            result = MODEL.transcribe(
+                audio,
+                language='zh',
+                translate=False
+            )
+        finally:
+            del audio  # 释放对共享内存的引用后才能 close
+    finally:
+        shm.close()
+
+    # 提取文本（result 是 Segment 对象列表）
+    if isinstance(result, list) and len(result) > 0:
+        return " ".join([seg.text for seg in result if hasattr(seg, 'text')])
+    elif isinstance(result, str):
+        return result
+    return ""
@@ -5,6 +5,8 @@
 import pyaudio
 import wave
 import sys
+import time
+import numpy as np
 
 def record_audio(filename="test.wav", duration=5):
     """录制音频"""
@@ -18,22 +20,33 @@ def record_audio(filename="test.wav", duration=5):
     print(f"🎤 开始录音 ({duration} 秒)...")
     print("请说话...")
     
+    # 预分配整段录音，回调在 PortAudio 线程里直接写入，不逐帧拼 bytes
+    total = RATE * duration
+    buf = np.empty(total, dtype=np.int16)
+    idx = [0]
+    
+    def callback(in_data, frame_count, time_info, status):
+        n = min(frame_count, total - idx[0])
+        buf[idx[0]:idx[0] + n] = np.frombuffer(in_data, dtype=np.int16)[:n]
+        idx[0] += n
+        if idx[0] >= total:
+            return (None, pyaudio.paComplete)
+        return (None, pyaudio.paContinue)
+    
     stream = p.open(
         format=FORMAT,
         channels=CHANNELS,
         rate=RATE,
         input=True,
-        frames_per_buffer=CHUNK
+        frames_per_buffer=CHUNK,
+        stream_callback=callback
     )
     
-    frames = []
-    
-    for i in range(0, int(RATE / CHUNK * duration)):
-        data = stream.read(CHUNK)
-        frames.append(data)
+    while stream.is_active():
+        time.sleep(0.1)
         
         # 显示进度
-        progress = (i + 1) / (RATE / CHUNK * duration) * 100
+        progress = idx[0] / total * 100
         print(f"\r录音中... {progress:.0f}%", end="")
     
     print("\n✅ 录音完成！")
@@ -47,7 +60,7 @@ def record_audio(filename="test.wav", duration=5):
     wf.setnchannels(CHANNELS)
     wf.setsampwidth(p.get_sample_size(FORMAT))
     wf.setframerate(RATE)
-    wf.writeframes(b''.join(frames))
+    wf.writeframes(buf[:idx[0]].tobytes())
     wf.close()
     
     print(f"💾 已保存到: {filename}")
@@ -5,54 +5,160 @@
 """
 import asyncio
 import websockets
-import json
-import tempfile
+import orjson
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, BatchedInferencePipeline, decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps, merge_segments
+from batching import BatchQueue
+import numpy as np
 import wave
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 模型输入采样率（decode_audio 的默认输出）
+SAMPLE_RATE = 16000
+
 # 全局模型（启动时加载一次）
 MODEL = None
+PIPELINE = None  # 批量推理管线，VAD 切出的多个片段一次编码
+EXECUTOR = None  # 转录线程池，不阻塞事件循环
+BATCHER = None  # 所有客户端待转录的音频在这里合批
+
+# 模型配置（可用环境变量覆盖）
+# 注意：distil-large-v3 等 distil 模型只支持英文；CPU 上 CTranslate2 不支持 int8_float16
+MODEL_NAME = os.getenv("STT_MODEL", "base")
+COMPUTE_TYPE = os.getenv("STT_COMPUTE_TYPE", "int8")
+# 并发转录数：每个 worker 是共享权重的独立 CTranslate2 副本
+NUM_WORKERS = int(os.getenv("STT_NUM_WORKERS", 4))
+# 每个 worker 的线程数，默认把核数平分给各 worker，避免超订
+CPU_THREADS = int(os.getenv("STT_CPU_THREADS", max(1, (os.cpu_count() or 2) // NUM_WORKERS)))
+BATCH_SIZE = int(os.getenv("STT_BATCH_SIZE", 8))
+# 第一条请求到达后最多再等多久，凑其他客户端的片段一起推理
+BATCH_WAIT = 0.05
+# 与 vad_filter=True 时管线内部的切分一致：停顿 500ms 切开，每片不超过 30 秒
+VAD_OPTIONS = VadOptions(min_silence_duration_ms=500, max_speech_duration_s=30)
+# 压缩比高于该值视为重复循环（"你好你好你好..."）
+COMPRESSION_RATIO_THRESHOLD = 2.4
+# 无语音概率高且平均对数概率低的片段视为静音上的幻觉（批量管线不认 no_speech_threshold，自己过滤）
+NO_SPEECH_THRESHOLD = 0.6
+LOG_PROB_THRESHOLD = -1.0
+# 预先量化好的本地模型目录（见 README），存在时直接加载，省去启动时的量化
+MODELS_DIR = Path(__file__).parent / "models"
+
+def resolve_model(name: str, compute_type: str) -> str:
+    """优先使用 models/whisper-<name>-<compute_type>，否则按模型名下载"""
+    local = MODELS_DIR / f"whisper-{name}-{compute_type}"
+    return str(local) if local.is_dir() else name
 
 def init_model():
     """初始化 Whisper 模型"""
-    global MODEL
-    logger.info("正在加载 Whisper 模型...")
-    # base 模型，int8 量化，适合 M1
-    MODEL = WhisperModel("base", device="cpu", compute_type="int8")
+    global MODEL, PIPELINE, EXECUTOR, BATCHER
+    logger.info(f"正在加载 Whisper 模型 ({MODEL_NAME}, {COMPUTE_TYPE}, {NUM_WORKERS} x {CPU_THREADS} 线程)...")
+    # 默认 base 模型，int8 量化，适合 M1
+    MODEL = WhisperModel(
+        resolve_model(MODEL_NAME, COMPUTE_TYPE),
+        device="cpu",
+        compute_type=COMPUTE_TYPE,
+        cpu_threads=CPU_THREADS,
+        num_workers=NUM_WORKERS
+    )
+    PIPELINE = BatchedInferencePipeline(model=MODEL)
+    EXECUTOR = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+    # 按语音片段数凑批：凑满一个编码器批次（BATCH_SIZE）就提交
+    BATCHER = BatchQueue(
+        _transcribe_batch, EXECUTOR, BATCH_SIZE, BATCH_WAIT, NUM_WORKERS,
+        weight=lambda request: len(request[1])
+    )
     logger.info("模型加载完成")
 
+def to_json(data: dict) -> str:
+    """序列化消息（orjson 返回 bytes，转成 str 才会按文本帧发送）"""
+    return orjson.dumps(data).decode()
+
+def _redecode(clip, language: str) -> str:
+    """对陷入重复循环的片段逐级升温重解（批量管线只用第一个温度，不做回退）"""
+    segments, info = MODEL.transcribe(
+        clip,
+        language=language,
+        beam_size=1,
+        best_of=1,
+        temperature=[0.2, 0.4],  # 只有仍然重复/低置信度时才升到下一级
+        compression_ratio_threshold=COMPRESSION_RATIO_THRESHOLD,
+        no_speech_threshold=NO_SPEECH_THRESHOLD,
+        log_prob_threshold=LOG_PROB_THRESHOLD,
+        condition_on_previous_text=False,
+        without_timestamps=True
+    )
+    return "".join(segment.text for segment in segments)
+
+def _prepare(audio_data: bytes):
+    """在线程池中解码并做语音活动检测，返回 (PCM, 语音片段列表)"""
+    # 内存解码为 16kHz 单声道 float32（不落盘）
+    audio = decode_audio(io.BytesIO(audio_data))
+    return audio, merge_segments(get_speech_timestamps(audio, VAD_OPTIONS), VAD_OPTIONS)
+
+def _transcribe_batch(requests: list, language: str) -> list:
+    """在线程池中执行的同步批量转录，返回每条请求的文本（segments 是惰性生成器，也要在这里消费完）
+    
+    各请求的音频拼成一条，用 clip_timestamps 标出各自的语音片段，
+    不同客户端的片段一起送入编码器；每个片段输出的 segment 按 seek 对回原请求。
+    """
+    clips = []
+    owners = {}  # seek（帧号）-> 请求下标
+    offset = 0
+    for k, (audio, speech) in enumerate(requests):
+        for clip in speech:
+            clips.append({"start": offset + clip["start"], "end": offset + clip["end"]})
+            owners[int((offset + clip["start"]) / SAMPLE_RATE * MODEL.frames_per_second)] = k
+        offset += len(audio)
+    
+    parts = [[] for _ in requests]
+    if not clips:
+        return [""] * len(requests)
+    audio = np.concatenate([audio for audio, _ in requests])
+    
+    # 转录
+    segments, info = PIPELINE.transcribe(
+        audio,
+        language=language,
+        beam_size=1,  # 贪心解码，短语音准确率几乎不变，速度约 2 倍
+        best_of=1,
+        temperature=0,  # 批量管线只用这一个温度，回退见 _redecode
+        condition_on_previous_text=False,  # 避免重复/幻觉循环
+        without_timestamps=True,  # 只用文本，不生成时间戳 token
+        clip_timestamps=clips,  # 语音活动检测已在 _prepare 中完成
+        batch_size=BATCH_SIZE
+    )
+    
+    # 收集结果
+    for segment in segments:
+        if segment.no_speech_prob > NO_SPEECH_THRESHOLD and segment.avg_logprob < LOG_PROB_THRESHOLD:
+            continue
+        k = owners[segment.seek]
+        if segment.compression_ratio > COMPRESSION_RATIO_THRESHOLD:
+            logger.info(f"🔁 片段 {segment.start:.1f}-{segment.end:.1f}秒 疑似重复循环，升温重解")
+            clip = audio[int(segment.start * SAMPLE_RATE):int(segment.end * SAMPLE_RATE)]
+            parts[k].append(_redecode(clip, language))
+        else:
+            parts[k].append(segment.text)
+    
+    return ["".join(p).strip() for p in parts]
+
 async def transcribe_audio(audio_data: bytes, language="zh"):
     """转录音频数据"""
     try:
-        # 保存临时文件
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
-            tmp.write(audio_data)
-            tmp_path = tmp.name
-        
-        # 转录
-        segments, info = MODEL.transcribe(
-            tmp_path,
-            language=language,
-            beam_size=5,
-            vad_filter=True,  # 语音活动检测
-            vad_parameters=dict(min_silence_duration_ms=500)
-        )
-        
-        # 收集结果
-        text = ""
-        for segment in segments:
-            text += segment.text
-        
-        # 删除临时文件
-        os.unlink(tmp_path)
+        loop = asyncio.get_running_loop()
+        audio, speech = await loop.run_in_executor(EXECUTOR, _prepare, audio_data)
+        if not speech:
+            return ""
         
-        return text.strip()
+        # 和其他客户端的音频一起推理
+        return await BATCHER.submit((audio, speech), language)
     
     except Exception as e:
         logger.error(f"转录错误: {e}")
@@ -64,7 +170,7 @@ async def handle_client(websocket, path):
     logger.info(f"客户端 {client_id} 已连接")
     
     try:
-        await websocket.send(json.dumps({
+        await websocket.send(to_json({
             "type": "connected",
             "message": "已连接到 STT 服务"
         }))
@@ -75,7 +181,7 @@ async def handle_client(websocket, path):
                 logger.info(f"收到音频数据: {len(message)} 字节")
                 
                 # 发送处理中状态
-                await websocket.send(json.dumps({
+                await websocket.send(to_json({
                     "type": "processing",
                     "message": "正在转录..."
                 }))
@@ -85,13 +191,13 @@ async def handle_client(websocket, path):
                 
                 if text:
                     # 发送结果
-                    await websocket.send(json.dumps({
+                    await websocket.send(to_json({
                         "type": "result",
                         "text": text
                     }))
                     logger.info(f"转录结果: {text}")
                 else:
-                    await websocket.send(json.dumps({
+                    await websocket.send(to_json({
                         "type": "error",
                         "message": "转录失败"
                     }))
@@ -99,15 +205,15 @@ async def handle_client(websocket, path):
             elif isinstance(message, str):
                 # 接收控制命令
                 try:
-                    data = json.loads(message)
+                    data = orjson.loads(message)
                     cmd = data.get("command")
                     
                     if cmd == "ping":
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "pong"
                         }))
                     
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     logger.warning(f"无效的 JSON: {message}")
     
     except websockets.exceptions.ConnectionClosed:
@@ -119,6 +225,7 @@ async def main():
     """启动服务"""
     # 初始化模型
     init_model()
+    BATCHER.start()
     
     # 启动 WebSocket 服务器
     host = "0.0.0.0"
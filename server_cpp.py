@@ -5,11 +5,20 @@
 """
 import asyncio
 import websockets
-import json
-import tempfile
+import orjson
 import os
+import re
+import sys
+import subprocess
 import logging
-from pywhispercpp.model import Model
+import time
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from pywhispercpp.utils import download_model
+import cpp_worker
 
 try:
     from opencc import OpenCC
@@ -17,116 +26,424 @@ try:
 except ImportError:
     HAS_OPENCC = False
 
+# spawn 启动的推理 worker 会以 __mp_main__ 重新执行本文件；推理入口在 cpp_worker.py，
+# av、silero-vad（torch）、scipy 只在主进程导入
+HAS_VAD = HAS_SCIPY = False
+if __name__ != "__mp_main__":
+    import av
+    
+    try:
+        from silero_vad import load_silero_vad, VADIterator, get_speech_timestamps
+        HAS_VAD = True
+    except ImportError:
+        pass
+    
+    try:
+        from scipy.signal import butter, sosfilt
+        HAS_SCIPY = True
+    except ImportError:
+        pass
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 全局模型
-MODEL = None
+# 模型输入采样率
+SAMPLE_RATE = 16000
+# Silero VAD v5 在 16kHz 下每次处理 512 个样本
+VAD_WINDOW = 512
+
+# 最后一段最长 30 秒一切，多段并行转录
+MAX_CHUNK_SECONDS = 30
+
+# 静音门限：RMS 低于噪声底，或语音频段（300-3400Hz，需要 scipy）能量不足 1% 的段不送模型
+MIN_RMS = 0.005
+MIN_SPEECH_BAND_RATIO = 0.01
+SPEECH_BAND_SOS = butter(4, [300, 3400], btype="bandpass", fs=SAMPLE_RATE, output="sos") if HAS_SCIPY else None
+
+# 模型名：tiny, base, small, medium, large-v3
+MODEL_NAME = os.getenv("STT_MODEL", "base")
+
+def performance_cores() -> int:
+    """性能核数量：macOS 上读 P 核数（M1 为 4P+4E），其他平台按一半逻辑核估算物理核"""
+    if sys.platform == "darwin":
+        try:
+            out = subprocess.run(
+                ["sysctl", "-n", "hw.perflevel0.physicalcpu"],
+                capture_output=True, text=True, check=True
+            ).stdout
+            return int(out)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            pass
+    return max(1, (os.cpu_count() or 8) // 2)
+
+# 推理进程池：每个 worker 进程持有一份模型，和 WebSocket 事件循环互不抢 GIL，
+# n_threads * worker 数 ≈ 性能核数（线程落到 E 核会在每次同步时拖慢 P 核上的线程）
+NUM_WORKERS = int(os.getenv("STT_NUM_WORKERS", 4))
+N_THREADS = max(1, performance_cores() // NUM_WORKERS)
+
+# 推理进程池（模型只在 worker 进程中加载，见 cpp_worker.py）
+POOL = None
 CC = None
+T2S_TABLE = None  # 繁→简单字映射表（str.translate 用）
+T2S_PHRASES = None  # 不能逐字转换的词组
+
+def coreml_encoder_path(model_path: str) -> str:
+    """Core ML 编码器路径（ggml-base.bin -> ggml-base-encoder.mlmodelc）"""
+    return os.path.splitext(model_path)[0] + "-encoder.mlmodelc"
 
 def init_model():
     """初始化 Whisper.cpp 模型"""
-    global MODEL, CC
-    logger.info("正在加载 Whisper.cpp 模型 (C++ 实现)...")
+    global POOL, CC, T2S_TABLE, T2S_PHRASES
+    logger.info(f"正在加载 Whisper.cpp 模型 (C++ 实现, {NUM_WORKERS} 进程 x {N_THREADS} 线程)...")
     logger.info("首次运行会下载模型，请稍候...")
     
-    # 使用 base 模型，速度和准确率平衡
-    MODEL = Model(
-        'base',  # 或 'small', 'medium'
-        n_threads=8  # 使用 8 线程
+    # 默认 base 模型，速度和准确率平衡；先在主进程下载好，避免多个 worker 同时下载
+    model_path = download_model(MODEL_NAME)
+    
+    # 用 WHISPER_COREML=1 编译的 whisper.cpp 会自动加载同目录的 .mlmodelc，
+    # 编码器在 ANE/GPU 上运行，CPU 线程只用于解码
+    if os.path.isdir(coreml_encoder_path(model_path)):
+        logger.info(f"检测到 Core ML 编码器: {coreml_encoder_path(model_path)}")
+    elif sys.platform == "darwin":
+        logger.info("未找到 Core ML 编码器，编码器在 CPU 上运行（开启方法见 测试指南.md）")
+    POOL = ProcessPoolExecutor(
+        max_workers=NUM_WORKERS,
+        initializer=cpp_worker.init_worker,
+        initargs=(model_path, N_THREADS)
     )
+    # 预先拉起所有 worker，模型在启动时就加载好
+    list(POOL.map(cpp_worker.worker_ready, range(NUM_WORKERS)))
     
     logger.info("✅ 模型加载完成")
     
+    # 检查 VAD（每个会话单独持有一份，VAD 状态不能跨会话共享）
+    if HAS_VAD:
+        load_silero_vad()
+        logger.info("Silero VAD 已启用")
+    else:
+        logger.warning("未安装 silero-vad，退回按停顿时间分段")
+        logger.warning("安装命令: pip install silero-vad")
+    
     # 初始化繁简转换
     if HAS_OPENCC:
         CC = OpenCC('t2s')
-        logger.info("繁简转换已启用")
+        T2S_TABLE, T2S_PHRASES = load_t2s_table()
+        logger.info("繁简转换已启用" + ("（查表加速）" if T2S_TABLE is not None else ""))
+
+class StreamDecoder:
+    """流式解码器，后台线程把 webm/opus 字节流解码为 16kHz 单声道 float32
+    
+    MediaRecorder 只有第一个分片带容器头，后续分片无法单独解码，
+    所以整个会话共用一个解码器，按到达顺序喂入数据。
+    """
+    def __init__(self, on_pcm):
+        self.on_pcm = on_pcm
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = None
+    
+    def feed(self, data: bytes):
+        """喂入一个音频分片"""
+        with self.cond:
+            if self.closed:
+                return
+            self.pending.append(data)
+            self.cond.notify()
+        
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+    
+    def read(self, size=-1):
+        """供 PyAV 调用的阻塞读取，关闭且读完后返回 b"" 表示结束"""
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if not self.pending:
+                return b""
+            data = self.pending.popleft()
+            if 0 <= size < len(data):
+                self.pending.appendleft(data[size:])
+                data = data[:size]
+            return data
+    
+    def close(self):
+        """结束输入，解码线程处理完剩余数据后退出"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+    
+    def join(self):
+        """等待解码线程结束"""
+        if self.thread:
+            self.thread.join()
+    
+    def _run(self):
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+        try:
+            with av.open(self) as container:
+                for frame in container.decode(audio=0):
+                    for out in resampler.resample(frame):
+                        self.on_pcm(out.to_ndarray().reshape(-1))
+            # 冲刷重采样器中残留的样本
+            for out in resampler.resample(None):
+                self.on_pcm(out.to_ndarray().reshape(-1))
+        except Exception as e:
+            logger.error(f"音频流解码错误: {e}")
+            with self.cond:
+                self.closed = True
+                self.pending.clear()
 
 class AudioBuffer:
-    """音频缓冲区，实时流式转录"""
+    """音频缓冲区，实时流式转录
+    
+    字节流经 StreamDecoder 解码为 PCM，Silero VAD 给出语音起止点，
+    语音结束（或连续说话过长）时切出一段送去转录。
+    """
     def __init__(self):
-        self.buffer = bytearray()
-        self.all_text = []
+        self.decoder = StreamDecoder(self._on_pcm)
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()  # 有语音段可转录时置位
+        self.lock = threading.Lock()  # 解码线程与事件循环共享下面的状态
+        self.pcm = np.zeros(30 * SAMPLE_RATE, dtype=np.float32)  # 预分配的滚动 PCM 缓冲
+        self.head = 0  # 有效数据在 pcm 中的起点
+        self.num_samples = 0  # 有效样本数
+        self.offset = 0  # 有效数据起点在会话中的样本位置
+        self.use_vad = HAS_VAD
+        self.vad = None
+        self.vad_rest = np.zeros(0, dtype=np.float32)  # 不足一个 VAD 窗口的尾巴
+        self.speech_start = None  # 正在进行的语音起点
+        self.segments = collections.deque()  # 已结束的语音段 (起点, 终点)
+        self.all_text = ""  # 已完成段落的累积文本
         self.last_data_time = None
         self.last_transcribe_time = None
-        self.min_data_size = 30 * 1024  # 最小 30KB
+        self.min_samples = SAMPLE_RATE  # 最少 1 秒
+        self.min_speech = SAMPLE_RATE // 4  # 短于 0.25 秒的语音视为噪声
+        self.chunk_length = 25 * SAMPLE_RATE  # 连续说话 25 秒强制分段
         self.max_interval = 2.0  # 最多 2 秒就转录一次
         self.silence_threshold = 1.0
         self.is_segment_end = False  # 是否段落结束
+        self.cut = None  # 本次要转录的区间 (起点, 终点)
+        self.stopping = False  # 收到 stop 后转录任务做完当前这次就退出
         
     def add_data(self, data: bytes):
         """添加音频数据"""
-        import time
-        self.buffer.extend(data)
-        self.last_data_time = time.time()
+        self.decoder.feed(data)
+        self.last_data_time = time.monotonic()
+    
+    def stop_transcribing(self):
+        """通知转录任务退出"""
+        self.stopping = True
+        self.ready.set()
+    
+    def close(self):
+        """结束输入并等待解码完成（阻塞，需在线程池中调用）"""
+        self.decoder.close()
+        self.decoder.join()
+    
+    def _on_pcm(self, pcm: np.ndarray):
+        """解码线程回调：保存 PCM 并跑 VAD"""
+        with self.lock:
+            self._append(pcm)
         
-    def should_transcribe(self):
-        """是否应该转录（停顿或时间到）"""
-        import time
+        if not self.use_vad:
+            return
         
-        if len(self.buffer) < self.min_data_size:
-            return False
+        if self.vad is None:
+            # 每个会话独立的 VAD 状态，min_silence 200ms 判定语音结束
+            self.vad = VADIterator(
+                load_silero_vad(),
+                sampling_rate=SAMPLE_RATE,
+                min_silence_duration_ms=200
+            )
         
-        current_time = time.time()
+        data = np.concatenate([self.vad_rest, pcm])
+        n = len(data) // VAD_WINDOW * VAD_WINDOW
+        for i in range(0, n, VAD_WINDOW):
+            event = self.vad(data[i:i + VAD_WINDOW])
+            with self.lock:
+                self._on_vad_event(event, self.vad.current_sample)
+        self.vad_rest = data[n:]
         
-        # 触发1：停顿检测（段落结束）
-        if self.last_data_time:
-            silence_duration = current_time - self.last_data_time
-            if silence_duration >= self.silence_threshold:
-                logger.info(f"🔇 停顿 {silence_duration:.1f}秒 - 段落结束")
-                self.is_segment_end = True
-                self.last_transcribe_time = current_time
-                return True
+        with self.lock:
+            if self.speech_start is None and not self.segments and self.cut is None:
+                # 没有语音时只保留最近 1 秒，其余静音丢弃
+                self._drop_until(self.offset + self.num_samples - SAMPLE_RATE)
+    
+    def _on_vad_event(self, event, position):
+        """处理 VAD 事件（持锁调用）"""
+        if event and "start" in event:
+            self.speech_start = event["start"]
+        elif event and "end" in event and self.speech_start is not None:
+            if event["end"] - self.speech_start >= self.min_speech:
+                self.segments.append((self.speech_start, event["end"]))
+                self._notify()
+            self.speech_start = None
+        elif self.speech_start is not None and position - self.speech_start >= self.chunk_length:
+            # 连续说话过长，强制切一段
+            self.segments.append((self.speech_start, position))
+            self.speech_start = position
+            self._notify()
+    
+    def _notify(self):
+        """唤醒转录任务（在解码线程中调用）"""
+        self.loop.call_soon_threadsafe(self.ready.set)
+    
+    def _append(self, pcm: np.ndarray):
+        """追加 PCM，空间不够时先把有效数据挪到开头，仍不够再翻倍扩容（持锁调用）"""
+        if self.head + self.num_samples + len(pcm) > len(self.pcm):
+            size = len(self.pcm)
+            while size < self.num_samples + len(pcm):
+                size *= 2
+            grown = self.pcm if size == len(self.pcm) else np.empty(size, dtype=np.float32)
+            grown[:self.num_samples] = self.pcm[self.head:self.head + self.num_samples]
+            self.pcm = grown
+            self.head = 0
+        tail = self.head + self.num_samples
+        self.pcm[tail:tail + len(pcm)] = pcm
+        self.num_samples += len(pcm)
+    
+    def _slice(self, start, end):
+        """按会话样本位置取 PCM 副本（持锁调用）"""
+        start = max(start, self.offset) - self.offset + self.head
+        end = min(end - self.offset, self.num_samples) + self.head
+        return self.pcm[start:end].copy()
+    
+    def _drop_until(self, position):
+        """丢弃 position 之前的 PCM，只移动起点不拷贝（持锁调用）"""
+        k = min(position - self.offset, self.num_samples)
+        if k <= 0:
+            return
+        self.head += k
+        self.offset += k
+        self.num_samples -= k
         
-        # 触发2：持续说话，每2秒也转录（中间结果）
-        if self.last_transcribe_time:
-            time_since_last = current_time - self.last_transcribe_time
-            if time_since_last >= self.max_interval:
-                logger.info(f"⏱️ 持续说话 {time_since_last:.1f}秒 - 中间结果")
-                self.is_segment_end = False
-                self.last_transcribe_time = current_time
-                return True
-        else:
-            # 第一次转录
-            if len(self.buffer) >= self.min_data_size:
+    def should_transcribe(self):
+        """是否应该转录（语音结束或时间到）"""
+        current_time = time.monotonic()
+        
+        with self.lock:
+            if self.use_vad:
+                return self._check_vad(current_time)
+            
+            if self.num_samples < self.min_samples:
+                return False
+            
+            # 触发1：停顿检测（段落结束）
+            if self.last_data_time:
+                silence_duration = current_time - self.last_data_time
+                if silence_duration >= self.silence_threshold:
+                    logger.info(f"🔇 停顿 {silence_duration:.1f}秒 - 段落结束")
+                    self.is_segment_end = True
+                    self.cut = (self.offset, self.offset + self.num_samples)
+                    self.last_transcribe_time = current_time
+                    return True
+            
+            # 触发2：持续说话，每2秒也转录（中间结果）
+            if self.last_transcribe_time is None or current_time - self.last_transcribe_time >= self.max_interval:
+                logger.info(f"⏱️ 持续说话 - 中间结果")
                 self.is_segment_end = False
+                self.cut = (self.offset, self.offset + self.num_samples)
                 self.last_transcribe_time = current_time
                 return True
+            
+            return False
+    
+    def _check_vad(self, current_time):
+        """根据 VAD 结果判断（持锁调用）"""
+        # 触发1：VAD 检测到语音结束（段落结束）
+        if self.segments:
+            self.cut = self.segments.popleft()
+            logger.info(f"🔇 语音结束 {(self.cut[1] - self.cut[0]) / SAMPLE_RATE:.1f}秒 - 段落结束")
+            self.is_segment_end = True
+            self.last_transcribe_time = current_time
+            return True
+        
+        if self.speech_start is None:
+            return False
+        
+        # 触发2：持续说话，每2秒也转录（中间结果）
+        end = self.offset + self.num_samples
+        if end - self.speech_start < self.min_samples:
+            return False
+        if self.last_transcribe_time is None or current_time - self.last_transcribe_time >= self.max_interval:
+            logger.info(f"⏱️ 持续说话 {(end - self.speech_start) / SAMPLE_RATE:.1f}秒 - 中间结果")
+            self.is_segment_end = False
+            self.cut = (self.speech_start, end)
+            self.last_transcribe_time = current_time
+            return True
         
         return False
     
     def get_data_for_transcribe(self):
         """获取数据（根据是否段落结束决定是否清空）"""
-        if len(self.buffer) == 0:
-            return None, False
-        
-        chunk = bytes(self.buffer)
-        
-        # 如果是段落结束，清空缓冲区
-        if self.is_segment_end:
-            self.buffer.clear()
-            return chunk, True  # True = 段落结束
-        else:
-            # 中间结果，不清空
-            return chunk, False  # False = 继续累积
+        with self.lock:
+            if self.cut is None:
+                return None, False
+            
+            start, end = self.cut
+            self.cut = None
+            chunk = self._slice(start, end)
+            
+            # 如果是段落结束，丢弃这一段
+            if self.is_segment_end:
+                self._drop_until(end)
+                return chunk, True  # True = 段落结束
+            else:
+                # 中间结果，不清空
+                return chunk, False  # False = 继续累积
     
     def get_remaining_data(self):
         """获取剩余数据"""
-        if len(self.buffer) == 0:
-            return None, False
-        chunk = bytes(self.buffer)
-        self.buffer.clear()
-        return chunk, True  # 最后一段
+        with self.lock:
+            if self.num_samples == 0:
+                return None, False
+            end = self.offset + self.num_samples
+            chunk = self._slice(self.offset, end)
+            self._drop_until(end)
+            self.segments.clear()
+            self.speech_start = None
+            return chunk, True  # 最后一段
     
     def add_text(self, text: str):
-        """添加转录结果"""
+        """添加转录结果（只在段落结束时拼接一次）"""
         if text:
-            self.all_text.append(text)
+            self.all_text += text
     
     def get_full_text(self):
-        """获取完整转录结果"""
-        return "".join(self.all_text)
+        """获取完整转录结果，不再每次重新 join 整个列表"""
+        return self.all_text
+
+def _read_opencc_dict(path):
+    """读取 OpenCC 文本词典（每行: 繁体\t简体 [候选...]），取第一个候选"""
+    result = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            key, _, values = line.rstrip("\n").partition("\t")
+            if values:
+                result[key] = values.split(" ")[0]
+    return result
+
+def load_t2s_table():
+    """从 OpenCC 词典预建繁→简单字映射表，以及需要整词转换的词组正则
+    
+    单字用 str.translate（C 实现）转换，只有命中特殊词组时才走 CC.convert。
+    找不到文本词典（如 C++ 版 opencc）时返回 (None, None)，全部走 CC.convert。
+    """
+    import opencc
+    dict_dir = os.path.join(os.path.dirname(opencc.__file__), "dictionary")
+    try:
+        chars = _read_opencc_dict(os.path.join(dict_dir, "TSCharacters.txt"))
+        phrases = _read_opencc_dict(os.path.join(dict_dir, "TSPhrases.txt"))
+    except OSError:
+        return None, None
+    
+    table = str.maketrans({k: v for k, v in chars.items() if len(k) == 1})
+    # 只保留逐字转换结果不对的词组，长词优先匹配
+    special = sorted((k for k, v in phrases.items() if k.translate(table) != v), key=len, reverse=True)
+    pattern = re.compile("|".join(map(re.escape, special))) if special else None
+    return table, pattern
 
 def to_simplified_chinese(text: str) -> str:
     """转换为简体中文"""
@@ -135,39 +452,82 @@ def to_simplified_chinese(text: str) -> str:
     
     if HAS_OPENCC and CC:
         try:
+            if T2S_TABLE is not None and not (T2S_PHRASES and T2S_PHRASES.search(text)):
+                return text.translate(T2S_TABLE)
             return CC.convert(text)
         except Exception as e:
             logger.error(f"繁简转换错误: {e}")
             return text
     return text
 
-async def transcribe_chunk(audio_data: bytes):
-    """转录音频块"""
+def to_json(data: dict) -> str:
+    """序列化消息（orjson 返回 bytes，转成 str 才会按文本帧发送）"""
+    return orjson.dumps(data).decode()
+
+def split_on_silence(audio: np.ndarray):
+    """把长音频在 ≥300ms 的静音处切成不超过 30 秒的小段"""
+    max_len = MAX_CHUNK_SECONDS * SAMPLE_RATE
+    if len(audio) <= max_len:
+        return [audio]
+    
+    if not HAS_VAD:
+        return [audio[i:i + max_len] for i in range(0, len(audio), max_len)]
+    
+    speech = get_speech_timestamps(
+        audio,
+        load_silero_vad(),
+        sampling_rate=SAMPLE_RATE,
+        min_silence_duration_ms=300,
+        max_speech_duration_s=MAX_CHUNK_SECONDS
+    )
+    
+    # 相邻语音合并成组，每组不超过 30 秒，组间静音丢弃
+    chunks = []
+    start = end = None
+    for ts in speech:
+        if start is not None and ts["end"] - start > max_len:
+            chunks.append(audio[start:end])
+            start = None
+        if start is None:
+            start = ts["start"]
+        end = ts["end"]
+    if start is not None:
+        chunks.append(audio[start:end])
+    return chunks
+
+def is_silence(audio: np.ndarray) -> bool:
+    """能量低于噪声底，或几乎没有语音频段能量"""
+    if len(audio) == 0:
+        return True
+    energy = float(np.mean(np.square(audio)))
+    if np.sqrt(energy) < MIN_RMS:
+        return True
+    if SPEECH_BAND_SOS is not None:
+        band = sosfilt(SPEECH_BAND_SOS, audio)
+        if float(np.mean(np.square(band))) < MIN_SPEECH_BAND_RATIO * energy:
+            return True
+    return False
+
+async def transcribe_chunk(audio: np.ndarray):
+    """转录音频块（16kHz 单声道 float32 PCM）"""
+    if is_silence(audio):
+        logger.info(f"🔇 静音 {len(audio) / SAMPLE_RATE:.1f}秒，跳过转录")
+        return None
+    
     try:
-        # 保存临时文件
-        with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as tmp:
-            tmp.write(audio_data)
-            tmp_path = tmp.name
-        
-        logger.info(f"开始转录 {len(audio_data)} 字节")
+        logger.info(f"开始转录 {len(audio) / SAMPLE_RATE:.1f}秒")
         
-        # 转录
-        result = MODEL.transcribe(
-            tmp_path,
-            language='zh',
-            translate=False
-        )
-        
-        # 删除临时文件
-        os.unlink(tmp_path)
-        
-        # 提取文本（result 是 Segment 对象列表）
-        if isinstance(result, list) and len(result) > 0:
-            text = " ".join([seg.text for seg in result if hasattr(seg, 'text')])
-        elif isinstance(result, str):
-            text = result
-        else:
-            text = ""
+        # 转录（在 worker 进程中执行，PCM 经共享内存传递，省去 pickle 拷贝）
+        shm = shared_memory.SharedMemory(create=True, size=max(audio.nbytes, 1))
+        try:
+            buf = np.ndarray(audio.shape, dtype=np.float32, buffer=shm.buf)
+            buf[:] = audio
+            del buf
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(POOL, cpp_worker.worker_transcribe, shm.name, len(audio))
+        finally:
+            shm.close()
+            shm.unlink()
         
         text = text.strip()
         text = to_simplified_chinese(text)
@@ -178,43 +538,48 @@ async def transcribe_chunk(audio_data: bytes):
         logger.error(f"转录错误: {e}", exc_info=True)
         return None
 
-async def periodic_transcribe(buffer, websocket, interval=0.5):
-    """定时检查任务"""
-    transcribing = False
+async def transcribe_final(audio: np.ndarray):
+    """转录最后一段：长音频按静音切段后并行转录，再按顺序拼接"""
+    loop = asyncio.get_running_loop()
+    chunks = await loop.run_in_executor(None, split_on_silence, audio)
+    if len(chunks) > 1:
+        logger.info(f"✂️ 切成 {len(chunks)} 段并行转录")
     
-    while True:
-        await asyncio.sleep(interval)
-        
-        if transcribing:
-            continue
+    texts = await asyncio.gather(*[transcribe_chunk(c) for c in chunks])
+    return "".join(t for t in texts if t)
+
+async def periodic_transcribe(buffer, websocket):
+    """转录任务：等 VAD 通知（语音结束）或超时（停顿/中间结果）再检查"""
+    while not buffer.stopping:
+        try:
+            await asyncio.wait_for(buffer.ready.wait(), timeout=buffer.silence_threshold)
+        except asyncio.TimeoutError:
+            pass
+        buffer.ready.clear()
         
-        if buffer.should_transcribe():
-            transcribing = True
+        while not buffer.stopping and buffer.should_transcribe():
             chunk, is_segment_end = buffer.get_data_for_transcribe()
-            logger.info(f"🎙️ 转录 {len(chunk)} 字节")
+            logger.info(f"🎙️ 转录 {len(chunk) / SAMPLE_RATE:.1f}秒")
             
-            try:
-                text = await transcribe_chunk(chunk)
-                if text:
-                    if is_segment_end:
-                        # 段落结束，保存这段文本
-                        buffer.add_text(text)
-                        logger.info(f"✅ 段落: {text}")
-                    
-                    # 返回完整累积结果
-                    full_text = buffer.get_full_text()
-                    if not is_segment_end and text:
-                        # 中间结果，临时拼接
-                        full_text = full_text + text if full_text else text
-                    
-                    await websocket.send(json.dumps({
-                        "type": "partial",
-                        "text": full_text,
-                        "is_final": False
-                    }))
-                    logger.info(f"📝 返回: {full_text}")
-            finally:
-                transcribing = False
+            text = await transcribe_chunk(chunk)
+            if text:
+                if is_segment_end:
+                    # 段落结束，保存这段文本
+                    buffer.add_text(text)
+                    logger.info(f"✅ 段落: {text}")
+                
+                # 返回完整累积结果
+                full_text = buffer.get_full_text()
+                if not is_segment_end and text:
+                    # 中间结果，临时拼接
+                    full_text = full_text + text if full_text else text
+                
+                await websocket.send(to_json({
+                    "type": "partial",
+                    "text": full_text,
+                    "is_final": False
+                }))
+                logger.info(f"📝 返回: {full_text}")
 
 async def handle_streaming_client(websocket):
     """处理流式客户端连接"""
@@ -226,7 +591,7 @@ async def handle_streaming_client(websocket):
     transcribe_task = None
     
     try:
-        await websocket.send(json.dumps({
+        await websocket.send(to_json({
             "type": "connected",
             "message": "已连接到 Whisper.cpp STT 服务 (C++ 加速)",
             "mode": "streaming"
@@ -242,35 +607,35 @@ async def handle_streaming_client(websocket):
             
             elif isinstance(message, str):
                 try:
-                    data = json.loads(message)
+                    data = orjson.loads(message)
                     cmd = data.get("command")
                     
                     if cmd == "start":
+                        buffer.decoder.close()
                         buffer = AudioBuffer()
                         session_active = True
                         
                         transcribe_task = asyncio.create_task(
-                            periodic_transcribe(buffer, websocket, interval=0.5)
+                            periodic_transcribe(buffer, websocket)
                         )
                         
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "session_started"
                         }))
                         logger.info(f"✅ 开始新会话")
                     
                     elif cmd == "stop":
+                        # 不能直接取消：正在转录的语音段已从缓冲区取出，取消就丢了
                         if transcribe_task:
-                            transcribe_task.cancel()
-                            try:
-                                await transcribe_task
-                            except asyncio.CancelledError:
-                                pass
+                            buffer.stop_transcribing()
+                            await transcribe_task
                         
-                        # 处理剩余数据
+                        # 等解码线程处理完已收到的数据，再取剩余部分
+                        await asyncio.get_running_loop().run_in_executor(None, buffer.close)
                         remaining, _ = buffer.get_remaining_data()
-                        if remaining and len(remaining) > 10240:
-                            logger.info(f"🔄 最后一段 {len(remaining)} 字节")
-                            text = await transcribe_chunk(remaining)
+                        if remaining is not None and len(remaining) > SAMPLE_RATE * 0.3:
+                            logger.info(f"🔄 最后一段 {len(remaining) / SAMPLE_RATE:.1f}秒")
+                            text = await transcribe_final(remaining)
                             if text:
                                 buffer.add_text(text)
                                 logger.info(f"✅ 最后段: {text}")
@@ -279,24 +644,24 @@ async def handle_streaming_client(websocket):
                         full_text = buffer.get_full_text()
                         logger.info(f"📝 完整: {full_text}")
                         
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "final",
                             "text": full_text,
                             "is_final": True
                         }))
                         
                         session_active = False
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "session_ended"
                         }))
                         logger.info(f"✅ 结束")
                     
                     elif cmd == "ping":
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "pong"
                         }))
                     
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     logger.warning(f"⚠️ 无效 JSON: {e}")
     
     except websockets.exceptions.ConnectionClosed:
@@ -307,6 +672,8 @@ async def handle_streaming_client(websocket):
         logger.error(f"处理客户端 {client_id} 时出错: {e}", exc_info=True)
         if transcribe_task:
             transcribe_task.cancel()
+    finally:
+        buffer.decoder.close()
 
 async def main():
     """启动服务"""
@@ -6,9 +6,10 @@
 import asyncio
 import websockets
 import json
-import tempfile
-import os
 import logging
+import time
+import collections
+import numpy as np
 from transformers import pipeline
 import torch
 
@@ -18,9 +19,30 @@ try:
 except ImportError:
     HAS_OPENCC = False
 
+try:
+    from scipy.signal import butter, sosfilt
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 模型输入采样率
+SAMPLE_RATE = 16000
+# 常驻 ffmpeg：从 stdin 读任意容器（webm/ogg/mp4），输出 16kHz 单声道 float32
+FFMPEG_CMD = [
+    "ffmpeg", "-loglevel", "quiet",
+    "-i", "pipe:0",
+    "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE),
+    "pipe:1"
+]
+
+# 静音门限：RMS 或语音频段（300-3400Hz，需要 scipy）能量占比过低就跳过推理
+MIN_RMS = 0.005
+MIN_SPEECH_BAND_RATIO = 0.01
+SPEECH_BAND_SOS = butter(4, [300, 3400], btype="bandpass", fs=SAMPLE_RATE, output="sos") if HAS_SCIPY else None
+
 # 全局模型
 MODEL = None
 CC = None
@@ -50,29 +72,79 @@ def init_model():
         logger.info("繁简转换已启用")
 
 class AudioBuffer:
-    """音频缓冲区，分段转录"""
+    """音频缓冲区，分段转录
+    
+    每个会话一个常驻 ffmpeg 进程：WebSocket 分片写入 stdin，
+    stdout 输出 16kHz 单声道 float32 PCM，不再每段落盘、每段 fork ffmpeg。
+    """
     def __init__(self):
-        self.buffer = bytearray()
-        self.all_text = []
+        self.proc = None  # ffmpeg 解码进程
+        self.drain_task = None  # 读取 ffmpeg 输出的任务
+        self.buffer = collections.deque()  # PCM 块引用，转录时才拼接
+        self.num_samples = 0  # 已缓冲样本数
+        self.all_text = ""  # 已完成段落的累积文本
         self.last_data_time = None
-        self.min_data_size = 30 * 1024
+        self.min_samples = SAMPLE_RATE  # 最少 1 秒
         self.silence_threshold = 1.0
+    
+    async def _start_decoder(self):
+        """启动 ffmpeg 解码进程"""
+        self.proc = await asyncio.create_subprocess_exec(
+            *FFMPEG_CMD,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+        self.drain_task = asyncio.create_task(self._drain())
+    
+    async def _drain(self):
+        """持续读取 ffmpeg 输出的 PCM"""
+        rest = b""
+        while True:
+            data = await self.proc.stdout.read(65536)
+            if not data:
+                break
+            data = rest + data
+            n = len(data) // 4 * 4  # float32 对齐
+            if n:
+                pcm = np.frombuffer(data[:n], dtype=np.float32)
+                self.buffer.append(pcm)
+                self.num_samples += len(pcm)
+            rest = data[n:]
         
-    def add_data(self, data: bytes):
+    async def add_data(self, data: bytes):
         """添加音频数据"""
-        import time
-        self.buffer.extend(data)
-        self.last_data_time = time.time()
+        if self.proc is None:
+            await self._start_decoder()
+        
+        if self.proc.returncode is None:
+            try:
+                self.proc.stdin.write(data)
+                await self.proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                logger.warning("⚠️ ffmpeg 解码进程已退出，丢弃音频数据")
+        self.last_data_time = time.monotonic()
+    
+    async def finish(self):
+        """关闭输入，等 ffmpeg 把已收到的数据解码完"""
+        if self.proc is None:
+            return
+        if self.proc.returncode is None:
+            self.proc.stdin.close()
+        await self.drain_task
+        await self.proc.wait()
+    
+    def close(self):
+        """结束 ffmpeg 进程（断开连接或开始新会话时）"""
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.kill()
         
     def should_transcribe(self):
         """是否应该转录"""
-        import time
-        
-        if len(self.buffer) < self.min_data_size:
+        if self.num_samples < self.min_samples:
             return False
         
         if self.last_data_time:
-            silence_duration = time.time() - self.last_data_time
+            silence_duration = time.monotonic() - self.last_data_time
             if silence_duration >= self.silence_threshold:
                 logger.info(f"🔇 停顿 {silence_duration:.1f}秒")
                 return True
@@ -81,28 +153,30 @@ class AudioBuffer:
     
     def get_segment_for_transcribe(self):
         """获取当前段数据并清空"""
-        if len(self.buffer) == 0:
+        if self.num_samples == 0:
             return None
-        chunk = bytes(self.buffer)
+        chunk = np.concatenate(self.buffer)  # 一次分配、一次拷贝
         self.buffer.clear()
+        self.num_samples = 0
         return chunk
     
     def get_remaining_data(self):
         """获取剩余数据"""
-        if len(self.buffer) == 0:
+        if self.num_samples == 0:
             return None
-        chunk = bytes(self.buffer)
+        chunk = np.concatenate(self.buffer)  # 一次分配、一次拷贝
         self.buffer.clear()
+        self.num_samples = 0
         return chunk
     
     def add_text(self, text: str):
-        """添加转录结果"""
+        """添加转录结果（只在段落结束时拼接一次）"""
         if text:
-            self.all_text.append(text)
+            self.all_text += text
     
     def get_full_text(self):
-        """获取完整转录结果"""
-        return "".join(self.all_text)
+        """获取完整转录结果，不再每次重新 join 整个列表"""
+        return self.all_text
 
 def to_simplified_chinese(text: str) -> str:
     """转换为简体中文"""
@@ -117,28 +191,37 @@ def to_simplified_chinese(text: str) -> str:
             return text
     return text
 
-async def transcribe_chunk(audio_data: bytes):
-    """转录音频块"""
+def is_silence(audio: np.ndarray) -> bool:
+    """能量低于噪声底，或几乎没有语音频段能量"""
+    if len(audio) == 0:
+        return True
+    energy = float(np.mean(np.square(audio)))
+    if np.sqrt(energy) < MIN_RMS:
+        return True
+    if SPEECH_BAND_SOS is not None:
+        band = sosfilt(SPEECH_BAND_SOS, audio)
+        if float(np.mean(np.square(band))) < MIN_SPEECH_BAND_RATIO * energy:
+            return True
+    return False
+
+async def transcribe_chunk(audio: np.ndarray):
+    """转录音频块（16kHz 单声道 float32 PCM）"""
+    if is_silence(audio):
+        logger.info(f"🔇 静音 {len(audio) / SAMPLE_RATE:.1f}秒，跳过转录")
+        return None
+    
     try:
-        # 保存临时文件
-        with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as tmp:
-            tmp.write(audio_data)
-            tmp_path = tmp.name
-        
-        logger.info(f"开始转录 {len(audio_data)} 字节")
+        logger.info(f"开始转录 {len(audio) / SAMPLE_RATE:.1f}秒")
         
         # 转录
         result = MODEL(
-            tmp_path,
+            {"raw": audio, "sampling_rate": SAMPLE_RATE},
             generate_kwargs={
                 "language": "chinese",
                 "task": "transcribe"
             }
         )
         
-        # 删除临时文件
-        os.unlink(tmp_path)
-        
         # 提取文本
         text = result.get("text", "").strip()
         text = to_simplified_chinese(text)
@@ -162,7 +245,7 @@ async def periodic_transcribe(buffer, websocket, interval=0.5):
         if buffer.should_transcribe():
             transcribing = True
             segment = buffer.get_segment_for_transcribe()
-            logger.info(f"🎙️ 转录段 {len(segment)} 字节")
+            logger.info(f"🎙️ 转录段 {len(segment) / SAMPLE_RATE:.1f}秒")
             
             try:
                 text = await transcribe_chunk(segment)
@@ -201,7 +284,7 @@ async def handle_streaming_client(websocket, path):
                     session_active = True
                     logger.info(f"✅ 开始接收音频流")
                 
-                buffer.add_data(message)
+                await buffer.add_data(message)
             
             elif isinstance(message, str):
                 try:
@@ -209,6 +292,7 @@ async def handle_streaming_client(websocket, path):
                     cmd = data.get("command")
                     
                     if cmd == "start":
+                        buffer.close()
                         buffer = AudioBuffer()
                         session_active = True
                         
@@ -229,10 +313,11 @@ async def handle_streaming_client(websocket, path):
                             except asyncio.CancelledError:
                                 pass
                         
-                        # 处理剩余数据
+                        # 等 ffmpeg 解码完已收到的数据，再取剩余部分
+                        await buffer.finish()
                         remaining = buffer.get_remaining_data()
-                        if remaining and len(remaining) > 10240:
-                            logger.info(f"🔄 最后一段 {len(remaining)} 字节")
+                        if remaining is not None and len(remaining) > SAMPLE_RATE * 0.3:
+                            logger.info(f"🔄 最后一段 {len(remaining) / SAMPLE_RATE:.1f}秒")
                             text = await transcribe_chunk(remaining)
                             if text:
                                 buffer.add_text(text)
@@ -270,6 +355,8 @@ async def handle_streaming_client(websocket, path):
         logger.error(f"处理客户端 {client_id} 时出错: {e}", exc_info=True)
         if transcribe_task:
             transcribe_task.cancel()
+    finally:
+        buffer.close()
 
 async def main():
     """启动服务"""
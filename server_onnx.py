@@ -6,9 +6,10 @@
 import asyncio
 import websockets
 import json
-import tempfile
-import os
 import logging
+import time
+import collections
+import numpy as np
 
 try:
     from funasr_onnx import SenseVoiceSmall
@@ -25,6 +26,16 @@ except ImportError:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 模型输入采样率
+SAMPLE_RATE = 16000
+# 常驻 ffmpeg：从 stdin 读任意容器（webm/ogg/mp4），输出 16kHz 单声道 float32
+FFMPEG_CMD = [
+    "ffmpeg", "-loglevel", "quiet",
+    "-i", "pipe:0",
+    "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE),
+    "pipe:1"
+]
+
 # 全局模型
 MODEL = None
 CC = None
@@ -43,7 +54,8 @@ def init_model():
     MODEL = SenseVoiceSmall(
         model_dir="iic/SenseVoiceSmall",
         batch_size=1,
-        device_id=-1  # CPU
+        device_id=-1,  # CPU
+        quantize=True  # 动态 int8 量化
     )
     
     logger.info("✅ 模型加载完成")
@@ -54,29 +66,79 @@ def init_model():
         logger.info("繁简转换已启用")
 
 class AudioBuffer:
-    """音频缓冲区，分段转录"""
+    """音频缓冲区，分段转录
+    
+    每个会话一个常驻 ffmpeg 进程：WebSocket 分片写入 stdin，
+    stdout 输出 16kHz 单声道 float32 PCM，不再每段落盘、每段 fork ffmpeg。
+    """
     def __init__(self):
-        self.buffer = bytearray()
-        self.all_text = []
+        self.proc = None  # ffmpeg 解码进程
+        self.drain_task = None  # 读取 ffmpeg 输出的任务
+        self.buffer = collections.deque()  # PCM 块引用，转录时才拼接
+        self.num_samples = 0  # 已缓冲样本数
+        self.all_text = ""  # 已完成段落的累积文本
         self.last_data_time = None
-        self.min_data_size = 30 * 1024
+        self.min_samples = SAMPLE_RATE  # 最少 1 秒
         self.silence_threshold = 1.0
+    
+    async def _start_decoder(self):
+        """启动 ffmpeg 解码进程"""
+        self.proc = await asyncio.create_subprocess_exec(
+            *FFMPEG_CMD,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+        self.drain_task = asyncio.create_task(self._drain())
+    
+    async def _drain(self):
+        """持续读取 ffmpeg 输出的 PCM"""
+        rest = b""
+        while True:
+            data = await self.proc.stdout.read(65536)
+            if not data:
+                break
+            data = rest + data
+            n = len(data) // 4 * 4  # float32 对齐
+            if n:
+                pcm = np.frombuffer(data[:n], dtype=np.float32)
+                self.buffer.append(pcm)
+                self.num_samples += len(pcm)
+            rest = data[n:]
         
-    def add_data(self, data: bytes):
+    async def add_data(self, data: bytes):
         """添加音频数据"""
-        import time
-        self.buffer.extend(data)
-        self.last_data_time = time.time()
+        if self.proc is None:
+            await self._start_decoder()
+        
+        if self.proc.returncode is None:
+            try:
+                self.proc.stdin.write(data)
+                await self.proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                logger.warning("⚠️ ffmpeg 解码进程已退出，丢弃音频数据")
+        self.last_data_time = time.monotonic()
+    
+    async def finish(self):
+        """关闭输入，等 ffmpeg 把已收到的数据解码完"""
+        if self.proc is None:
+            return
+        if self.proc.returncode is None:
+            self.proc.stdin.close()
+        await self.drain_task
+        await self.proc.wait()
+    
+    def close(self):
+        """结束 ffmpeg 进程（断开连接或开始新会话时）"""
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.kill()
         
     def should_transcribe(self):
         """是否应该转录"""
-        import time
-        
-        if len(self.buffer) < self.min_data_size:
+        if self.num_samples < self.min_samples:
             return False
         
         if self.last_data_time:
-            silence_duration = time.time() - self.last_data_time
+            silence_duration = time.monotonic() - self.last_data_time
             if silence_duration >= self.silence_threshold:
                 logger.info(f"🔇 停顿 {silence_duration:.1f}秒")
                 return True
@@ -85,28 +147,30 @@ class AudioBuffer:
     
     def get_segment_for_transcribe(self):
         """获取当前段数据并清空"""
-        if len(self.buffer) == 0:
+        if self.num_samples == 0:
             return None
-        chunk = bytes(self.buffer)
+        chunk = np.concatenate(self.buffer)  # 一次分配、一次拷贝
         self.buffer.clear()
+        self.num_samples = 0
         return chunk
     
     def get_remaining_data(self):
         """获取剩余数据"""
-        if len(self.buffer) == 0:
+        if self.num_samples == 0:
             return None
-        chunk = bytes(self.buffer)
+        chunk = np.concatenate(self.buffer)  # 一次分配、一次拷贝
         self.buffer.clear()
+        self.num_samples = 0
         return chunk
     
     def add_text(self, text: str):
-        """添加转录结果"""
+        """添加转录结果（只在段落结束时拼接一次）"""
         if text:
-            self.all_text.append(text)
+            self.all_text += text
     
     def get_full_text(self):
-        """获取完整转录结果"""
-        return "".join(self.all_text)
+        """获取完整转录结果，不再每次重新 join 整个列表"""
+        return self.all_text
 
 def to_simplified_chinese(text: str) -> str:
     """转换为简体中文"""
@@ -121,30 +185,21 @@ def to_simplified_chinese(text: str) -> str:
             return text
     return text
 
-async def transcribe_chunk(audio_data: bytes):
-    """转录音频块"""
+async def transcribe_chunk(audio: np.ndarray):
+    """转录音频块（16kHz 单声道 float32 PCM）"""
     try:
-        # 保存临时文件
-        with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as tmp:
-            tmp.write(audio_data)
-            tmp_path = tmp.name
-        
-        logger.info(f"开始转录 {len(audio_data)} 字节")
+        logger.info(f"开始转录 {len(audio) / SAMPLE_RATE:.1f}秒")
         
         # 转录
         result = MODEL(
-            audio_in=tmp_path,
+            audio,
             language="zh",
-            use_itn=True
+            textnorm="withitn"  # 逆文本归一化（funasr-onnx 不认 use_itn）
         )
         
-        # 删除临时文件
-        os.unlink(tmp_path)
-        
-        # 提取文本
+        # 提取文本（funasr-onnx 返回文本列表）
         if result and len(result) > 0:
-            text = result[0].get("text", "")
-            text = text.strip()
+            text = result[0].strip()
             text = to_simplified_chinese(text)
             logger.info(f"转录完成: {text}")
             return text
@@ -168,7 +223,7 @@ async def periodic_transcribe(buffer, websocket, interval=0.5):
         if buffer.should_transcribe():
             transcribing = True
             segment = buffer.get_segment_for_transcribe()
-            logger.info(f"🎙️ 转录段 {len(segment)} 字节")
+            logger.info(f"🎙️ 转录段 {len(segment) / SAMPLE_RATE:.1f}秒")
             
             try:
                 text = await transcribe_chunk(segment)
@@ -207,7 +262,7 @@ async def handle_streaming_client(websocket, path):
                     session_active = True
                     logger.info(f"✅ 开始接收音频流")
                 
-                buffer.add_data(message)
+                await buffer.add_data(message)
             
             elif isinstance(message, str):
                 try:
@@ -215,6 +270,7 @@ async def handle_streaming_client(websocket, path):
                     cmd = data.get("command")
                     
                     if cmd == "start":
+                        buffer.close()
                         buffer = AudioBuffer()
                         session_active = True
                         
@@ -235,10 +291,11 @@ async def handle_streaming_client(websocket, path):
                             except asyncio.CancelledError:
                                 pass
                         
-                        # 处理剩余数据
+                        # 等 ffmpeg 解码完已收到的数据，再取剩余部分
+                        await buffer.finish()
                         remaining = buffer.get_remaining_data()
-                        if remaining and len(remaining) > 10240:
-                            logger.info(f"🔄 最后一段 {len(remaining)} 字节")
+                        if remaining is not None and len(remaining) > SAMPLE_RATE * 0.3:
+                            logger.info(f"🔄 最后一段 {len(remaining) / SAMPLE_RATE:.1f}秒")
                             text = await transcribe_chunk(remaining)
                             if text:
                                 buffer.add_text(text)
@@ -276,6 +333,8 @@ async def handle_streaming_client(websocket, path):
         logger.error(f"处理客户端 {client_id} 时出错: {e}", exc_info=True)
         if transcribe_task:
             transcribe_task.cancel()
+    finally:
+        buffer.close()
 
 async def main():
     """启动服务"""
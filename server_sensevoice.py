@@ -5,105 +5,379 @@
 """
 import asyncio
 import websockets
-import json
-import tempfile
+import orjson
 import os
+import re
 import logging
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import av
+import numpy as np
 from funasr import AutoModel
 
+try:
+    from funasr_onnx import SenseVoiceSmall
+    HAS_ONNX = True
+except ImportError:
+    HAS_ONNX = False
+
 try:
     from opencc import OpenCC
     HAS_OPENCC = True
 except ImportError:
     HAS_OPENCC = False
 
+try:
+    from silero_vad import load_silero_vad, VADIterator, get_speech_timestamps
+    HAS_VAD = True
+except ImportError:
+    HAS_VAD = False
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 模型输入采样率
+SAMPLE_RATE = 16000
+# Silero VAD v5 在 16kHz 下每次处理 512 个样本
+VAD_WINDOW = 512
+
+# 最后一段最长 30 秒一切，多段一次批量转录
+MAX_CHUNK_SECONDS = 30
+
+# CPU 上默认走 ONNX Runtime + 动态 int8 量化，STT_BACKEND=torch 退回 PyTorch fp32
+USE_ONNX = HAS_ONNX and os.getenv("STT_BACKEND", "onnx") == "onnx"
+# ONNX Runtime 推理线程数
+CPU_THREADS = int(os.getenv("STT_CPU_THREADS", 4))
+# 并行推理线程数：ONNX 会话可多线程同时 run，按核数平分；PyTorch 版单次调用原生批量、已占满所有核
+INFER_WORKERS = max(1, (os.cpu_count() or 2) // CPU_THREADS) if USE_ONNX else 1
+
 # 全局模型
 MODEL = None
+EXECUTOR = None  # 推理线程池，不阻塞事件循环
 CC = None
+T2S_TABLE = None  # 繁→简单字映射表（str.translate 用）
+T2S_PHRASES = None  # 不能逐字转换的词组
 
 def init_model():
-    """初始化 SenseVoice 模型（从 HuggingFace 下载）"""
-    global MODEL, CC
-    logger.info("正在从 HuggingFace 加载 SenseVoice-Small 模型...")
-    logger.info("这可能需要 1-2 分钟，请耐心等待...")
+    """初始化 SenseVoice 模型（ONNX int8 或 PyTorch）"""
+    global MODEL, EXECUTOR, CC, T2S_TABLE, T2S_PHRASES
     
     # 设置详细日志
     import logging
     logging.getLogger("funasr").setLevel(logging.INFO)
     
-    MODEL = AutoModel(
-        model="FunAudioLLM/SenseVoiceSmall",
-        hub="hf",
-        device="cpu",
-        disable_pbar=False,
-        disable_log=False,  # 显示日志
-        disable_update=True
-    )
+    if USE_ONNX:
+        # 首次运行会下载模型并导出 model_quant.onnx（int8 动态量化）
+        logger.info("正在加载 SenseVoice-Small ONNX int8 模型...")
+        MODEL = SenseVoiceSmall(
+            model_dir="iic/SenseVoiceSmall",
+            device_id=-1,  # CPU
+            quantize=True,
+            intra_op_num_threads=CPU_THREADS
+        )
+    else:
+        if not HAS_ONNX:
+            logger.warning("未安装 funasr-onnx，使用 PyTorch 模型")
+            logger.warning("安装命令: pip install funasr-onnx onnxruntime")
+        logger.info("正在从 HuggingFace 加载 SenseVoice-Small 模型...")
+        logger.info("这可能需要 1-2 分钟，请耐心等待...")
+        MODEL = AutoModel(
+            model="FunAudioLLM/SenseVoiceSmall",
+            hub="hf",
+            device="cpu",
+            disable_pbar=False,
+            disable_log=False,  # 显示日志
+            disable_update=True
+        )
     
+    EXECUTOR = ThreadPoolExecutor(max_workers=INFER_WORKERS)
     logger.info("✅ 模型加载完成")
     
+    # 检查 VAD（每个会话单独持有一份，VAD 状态不能跨会话共享）
+    if HAS_VAD:
+        load_silero_vad()
+        logger.info("Silero VAD 已启用")
+    else:
+        logger.warning("未安装 silero-vad，退回按停顿时间分段")
+        logger.warning("安装命令: pip install silero-vad")
+    
     # 初始化繁简转换
     if HAS_OPENCC:
         CC = OpenCC('t2s')
-        logger.info("繁简转换已启用")
+        T2S_TABLE, T2S_PHRASES = load_t2s_table()
+        logger.info("繁简转换已启用" + ("（查表加速）" if T2S_TABLE is not None else ""))
+
+class StreamDecoder:
+    """流式解码器，后台线程把 webm/opus 字节流解码为 16kHz 单声道 float32
+    
+    MediaRecorder 只有第一个分片带容器头，后续分片无法单独解码，
+    所以整个会话共用一个解码器，按到达顺序喂入数据。
+    """
+    def __init__(self, on_pcm):
+        self.on_pcm = on_pcm
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = None
+    
+    def feed(self, data: bytes):
+        """喂入一个音频分片"""
+        with self.cond:
+            if self.closed:
+                return
+            self.pending.append(data)
+            self.cond.notify()
+        
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+    
+    def read(self, size=-1):
+        """供 PyAV 调用的阻塞读取，关闭且读完后返回 b"" 表示结束"""
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if not self.pending:
+                return b""
+            data = self.pending.popleft()
+            if 0 <= size < len(data):
+                self.pending.appendleft(data[size:])
+                data = data[:size]
+            return data
+    
+    def close(self):
+        """结束输入，解码线程处理完剩余数据后退出"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+    
+    def join(self):
+        """等待解码线程结束"""
+        if self.thread:
+            self.thread.join()
+    
+    def _run(self):
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+        try:
+            with av.open(self) as container:
+                for frame in container.decode(audio=0):
+                    for out in resampler.resample(frame):
+                        self.on_pcm(out.to_ndarray().reshape(-1))
+            # 冲刷重采样器中残留的样本
+            for out in resampler.resample(None):
+                self.on_pcm(out.to_ndarray().reshape(-1))
+        except Exception as e:
+            logger.error(f"音频流解码错误: {e}")
+            with self.cond:
+                self.closed = True
+                self.pending.clear()
 
 class AudioBuffer:
-    """音频缓冲区，分段转录"""
+    """音频缓冲区，分段转录
+    
+    字节流经 StreamDecoder 解码为 PCM，Silero VAD 给出语音起止点，
+    语音结束（或连续说话过长）时切出一段送去转录。
+    """
     def __init__(self):
-        self.buffer = bytearray()
-        self.all_text = []
+        self.decoder = StreamDecoder(self._on_pcm)
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()  # 有语音段可转录时置位
+        self.lock = threading.Lock()  # 解码线程与事件循环共享下面的状态
+        self.pcm = np.zeros(30 * SAMPLE_RATE, dtype=np.float32)  # 预分配的滚动 PCM 缓冲
+        self.head = 0  # 有效数据在 pcm 中的起点
+        self.num_samples = 0  # 有效样本数
+        self.offset = 0  # 有效数据起点在会话中的样本位置
+        self.use_vad = HAS_VAD
+        self.vad = None
+        self.vad_rest = np.zeros(0, dtype=np.float32)  # 不足一个 VAD 窗口的尾巴
+        self.speech_start = None  # 正在进行的语音起点
+        self.segments = collections.deque()  # 已结束的语音段 (起点, 终点)
+        self.all_text = ""  # 已完成段落的累积文本
         self.last_data_time = None
-        self.min_data_size = 30 * 1024  # 30KB
+        self.min_samples = SAMPLE_RATE  # 最少 1 秒
+        self.min_speech = SAMPLE_RATE // 4  # 短于 0.25 秒的语音视为噪声
+        self.chunk_length = 25 * SAMPLE_RATE  # 连续说话 25 秒强制分段
         self.silence_threshold = 1.0  # 1秒停顿
+        self.cut = None  # 本次要转录的区间 (起点, 终点)
+        self.stopping = False  # 收到 stop 后转录任务做完当前这次就退出
         
     def add_data(self, data: bytes):
         """添加音频数据"""
-        import time
-        self.buffer.extend(data)
-        self.last_data_time = time.time()
+        self.decoder.feed(data)
+        self.last_data_time = time.monotonic()
+    
+    def stop_transcribing(self):
+        """通知转录任务退出"""
+        self.stopping = True
+        self.ready.set()
+    
+    def close(self):
+        """结束输入并等待解码完成（阻塞，需在线程池中调用）"""
+        self.decoder.close()
+        self.decoder.join()
+    
+    def _on_pcm(self, pcm: np.ndarray):
+        """解码线程回调：保存 PCM 并跑 VAD"""
+        with self.lock:
+            self._append(pcm)
         
-    def should_transcribe(self):
-        """是否应该转录"""
-        import time
+        if not self.use_vad:
+            return
         
-        if len(self.buffer) < self.min_data_size:
-            return False
+        if self.vad is None:
+            # 每个会话独立的 VAD 状态，min_silence 200ms 判定语音结束
+            self.vad = VADIterator(
+                load_silero_vad(),
+                sampling_rate=SAMPLE_RATE,
+                min_silence_duration_ms=200
+            )
         
-        if self.last_data_time:
-            silence_duration = time.time() - self.last_data_time
-            if silence_duration >= self.silence_threshold:
-                logger.info(f"🔇 停顿 {silence_duration:.1f}秒")
-                return True
+        data = np.concatenate([self.vad_rest, pcm])
+        n = len(data) // VAD_WINDOW * VAD_WINDOW
+        for i in range(0, n, VAD_WINDOW):
+            event = self.vad(data[i:i + VAD_WINDOW])
+            with self.lock:
+                self._on_vad_event(event, self.vad.current_sample)
+        self.vad_rest = data[n:]
         
-        return False
+        with self.lock:
+            if self.speech_start is None and not self.segments and self.cut is None:
+                # 没有语音时只保留最近 1 秒，其余静音丢弃
+                self._drop_until(self.offset + self.num_samples - SAMPLE_RATE)
+    
+    def _on_vad_event(self, event, position):
+        """处理 VAD 事件（持锁调用）"""
+        if event and "start" in event:
+            self.speech_start = event["start"]
+        elif event and "end" in event and self.speech_start is not None:
+            if event["end"] - self.speech_start >= self.min_speech:
+                self.segments.append((self.speech_start, event["end"]))
+                self._notify()
+            self.speech_start = None
+        elif self.speech_start is not None and position - self.speech_start >= self.chunk_length:
+            # 连续说话过长，强制切一段
+            self.segments.append((self.speech_start, position))
+            self.speech_start = position
+            self._notify()
+    
+    def _notify(self):
+        """唤醒转录任务（在解码线程中调用）"""
+        self.loop.call_soon_threadsafe(self.ready.set)
+    
+    def _append(self, pcm: np.ndarray):
+        """追加 PCM，空间不够时先把有效数据挪到开头，仍不够再翻倍扩容（持锁调用）"""
+        if self.head + self.num_samples + len(pcm) > len(self.pcm):
+            size = len(self.pcm)
+            while size < self.num_samples + len(pcm):
+                size *= 2
+            grown = self.pcm if size == len(self.pcm) else np.empty(size, dtype=np.float32)
+            grown[:self.num_samples] = self.pcm[self.head:self.head + self.num_samples]
+            self.pcm = grown
+            self.head = 0
+        tail = self.head + self.num_samples
+        self.pcm[tail:tail + len(pcm)] = pcm
+        self.num_samples += len(pcm)
+    
+    def _slice(self, start, end):
+        """按会话样本位置取 PCM 副本（持锁调用）"""
+        start = max(start, self.offset) - self.offset + self.head
+        end = min(end - self.offset, self.num_samples) + self.head
+        return self.pcm[start:end].copy()
+    
+    def _drop_until(self, position):
+        """丢弃 position 之前的 PCM，只移动起点不拷贝（持锁调用）"""
+        k = min(position - self.offset, self.num_samples)
+        if k <= 0:
+            return
+        self.head += k
+        self.offset += k
+        self.num_samples -= k
+        
+    def should_transcribe(self):
+        """是否应该转录"""
+        with self.lock:
+            if self.use_vad:
+                if not self.segments:
+                    return False
+                self.cut = self.segments.popleft()
+                logger.info(f"🔇 语音结束 {(self.cut[1] - self.cut[0]) / SAMPLE_RATE:.1f}秒")
+                return True
+            
+            if self.num_samples < self.min_samples:
+                return False
+            
+            if self.last_data_time:
+                silence_duration = time.monotonic() - self.last_data_time
+                if silence_duration >= self.silence_threshold:
+                    logger.info(f"🔇 停顿 {silence_duration:.1f}秒")
+                    self.cut = (self.offset, self.offset + self.num_samples)
+                    return True
+            
+            return False
     
     def get_segment_for_transcribe(self):
         """获取当前段数据并清空"""
-        if len(self.buffer) == 0:
-            return None
-        chunk = bytes(self.buffer)
-        self.buffer.clear()
-        return chunk
+        with self.lock:
+            if self.cut is None:
+                return None
+            start, end = self.cut
+            self.cut = None
+            chunk = self._slice(start, end)
+            self._drop_until(end)
+            return chunk
     
     def get_remaining_data(self):
         """获取剩余数据"""
-        if len(self.buffer) == 0:
-            return None
-        chunk = bytes(self.buffer)
-        self.buffer.clear()
-        return chunk
+        with self.lock:
+            if self.num_samples == 0:
+                return None
+            end = self.offset + self.num_samples
+            chunk = self._slice(self.offset, end)
+            self._drop_until(end)
+            self.segments.clear()
+            self.speech_start = None
+            return chunk
     
     def add_text(self, text: str):
-        """添加转录结果"""
+        """添加转录结果（只在段落结束时拼接一次）"""
         if text:
-            self.all_text.append(text)
+            self.all_text += text
     
     def get_full_text(self):
-        """获取完整转录结果"""
-        return "".join(self.all_text)
+        """获取完整转录结果，不再每次重新 join 整个列表"""
+        return self.all_text
+
+def _read_opencc_dict(path):
+    """读取 OpenCC 文本词典（每行: 繁体\t简体 [候选...]），取第一个候选"""
+    result = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            key, _, values = line.rstrip("\n").partition("\t")
+            if values:
+                result[key] = values.split(" ")[0]
+    return result
+
+def load_t2s_table():
+    """从 OpenCC 词典预建繁→简单字映射表，以及需要整词转换的词组正则
+    
+    单字用 str.translate（C 实现）转换，只有命中特殊词组时才走 CC.convert。
+    找不到文本词典（如 C++ 版 opencc）时返回 (None, None)，全部走 CC.convert。
+    """
+    import opencc
+    dict_dir = os.path.join(os.path.dirname(opencc.__file__), "dictionary")
+    try:
+        chars = _read_opencc_dict(os.path.join(dict_dir, "TSCharacters.txt"))
+        phrases = _read_opencc_dict(os.path.join(dict_dir, "TSPhrases.txt"))
+    except OSError:
+        return None, None
+    
+    table = str.maketrans({k: v for k, v in chars.items() if len(k) == 1})
+    # 只保留逐字转换结果不对的词组，长词优先匹配
+    special = sorted((k for k, v in phrases.items() if k.translate(table) != v), key=len, reverse=True)
+    pattern = re.compile("|".join(map(re.escape, special))) if special else None
+    return table, pattern
 
 def to_simplified_chinese(text: str) -> str:
     """转换为简体中文"""
@@ -112,37 +386,79 @@ def to_simplified_chinese(text: str) -> str:
     
     if HAS_OPENCC and CC:
         try:
+            if T2S_TABLE is not None and not (T2S_PHRASES and T2S_PHRASES.search(text)):
+                return text.translate(T2S_TABLE)
             return CC.convert(text)
         except Exception as e:
             logger.error(f"繁简转换错误: {e}")
             return text
     return text
 
-async def transcribe_chunk(audio_data: bytes):
-    """转录音频块"""
+def to_json(data: dict) -> str:
+    """序列化消息（orjson 返回 bytes，转成 str 才会按文本帧发送）"""
+    return orjson.dumps(data).decode()
+
+def split_on_silence(audio: np.ndarray):
+    """把长音频在 ≥300ms 的静音处切成不超过 30 秒的小段"""
+    max_len = MAX_CHUNK_SECONDS * SAMPLE_RATE
+    if len(audio) <= max_len:
+        return [audio]
+    
+    if not HAS_VAD:
+        return [audio[i:i + max_len] for i in range(0, len(audio), max_len)]
+    
+    speech = get_speech_timestamps(
+        audio,
+        load_silero_vad(),
+        sampling_rate=SAMPLE_RATE,
+        min_silence_duration_ms=300,
+        max_speech_duration_s=MAX_CHUNK_SECONDS
+    )
+    
+    # 相邻语音合并成组，每组不超过 30 秒，组间静音丢弃
+    chunks = []
+    start = end = None
+    for ts in speech:
+        if start is not None and ts["end"] - start > max_len:
+            chunks.append(audio[start:end])
+            start = None
+        if start is None:
+            start = ts["start"]
+        end = ts["end"]
+    if start is not None:
+        chunks.append(audio[start:end])
+    return chunks
+
+def generate(audio):
+    """调用模型，audio 为一段或多段 PCM，返回每段文本"""
+    if USE_ONNX:
+        # funasr-onnx 把 list 输入当作文件路径列表，多段只能逐段调用；
+        # 它不认 use_itn，逆文本归一化用 textnorm 指定
+        audios = audio if isinstance(audio, list) else [audio]
+        return [
+            "".join(MODEL(a, language="zh", textnorm="withitn")).strip()
+            for a in audios
+        ]
+    
+    result = MODEL.generate(
+        input=audio,
+        language="zh",
+        use_itn=True,  # 逆文本归一化
+        batch_size=len(audio) if isinstance(audio, list) else 1
+    )
+    return [r.get("text", "").strip() for r in result or []]
+
+async def transcribe_chunk(audio: np.ndarray):
+    """转录音频块（16kHz 单声道 float32 PCM）"""
     try:
-        # 保存临时文件
-        with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as tmp:
-            tmp.write(audio_data)
-            tmp_path = tmp.name
-        
-        logger.info(f"开始转录 {len(audio_data)} 字节")
-        
-        # 转录
-        result = MODEL.generate(
-            input=tmp_path,
-            language="zh",
-            use_itn=True  # 逆文本归一化
-        )
+        logger.info(f"开始转录 {len(audio) / SAMPLE_RATE:.1f}秒")
         
-        # 删除临时文件
-        os.unlink(tmp_path)
+        # 转录（放到推理线程，其他会话的收发和 ping 不受影响）
+        result = await asyncio.get_running_loop().run_in_executor(EXECUTOR, generate, audio)
         
         # 提取文本
-        if result and len(result) > 0:
-            text = result[0].get("text", "")
-            text = text.strip()
-            text = to_simplified_chinese(text)
+        if result:
+            text = to_simplified_chinese(result[0])
             logger.info(f"转录完成: {text}")
             return text
         
@@ -152,35 +468,56 @@ async def transcribe_chunk(audio_data: bytes):
         logger.error(f"转录错误: {e}", exc_info=True)
         return None
 
-async def periodic_transcribe(buffer, websocket, interval=0.5):
-    """定时检查任务"""
-    transcribing = False
+async def transcribe_final(audio: np.ndarray):
+    """转录最后一段：长音频按静音切段后并行推理（ONNX 每段一个任务，PyTorch 一次批量），再按顺序拼接"""
+    loop = asyncio.get_running_loop()
+    chunks = await loop.run_in_executor(None, split_on_silence, audio)
+    if len(chunks) == 1:
+        return await transcribe_chunk(chunks[0])
     
-    while True:
-        await asyncio.sleep(interval)
+    try:
+        logger.info(f"✂️ 切成 {len(chunks)} 段并行转录 {len(audio) / SAMPLE_RATE:.1f}秒")
         
-        if transcribing:
-            continue
+        if USE_ONNX:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(EXECUTOR, generate, chunk) for chunk in chunks)
+            )
+            texts = [result[0] if result else "" for result in results]
+        else:
+            texts = await loop.run_in_executor(EXECUTOR, generate, chunks)
+        texts = [to_simplified_chinese(t) for t in texts]
+        text = "".join(t for t in texts if t)
+        logger.info(f"转录完成: {text}")
+        return text
+    
+    except Exception as e:
+        logger.error(f"转录错误: {e}", exc_info=True)
+        return None
+
+async def periodic_transcribe(buffer, websocket):
+    """转录任务：等 VAD 通知（语音结束）或超时（停顿/中间结果）再检查"""
+    while not buffer.stopping:
+        try:
+            await asyncio.wait_for(buffer.ready.wait(), timeout=buffer.silence_threshold)
+        except asyncio.TimeoutError:
+            pass
+        buffer.ready.clear()
         
-        if buffer.should_transcribe():
-            transcribing = True
+        while not buffer.stopping and buffer.should_transcribe():
             segment = buffer.get_segment_for_transcribe()
-            logger.info(f"🎙️ 转录段 {len(segment)} 字节")
+            logger.info(f"🎙️ 转录段 {len(segment) / SAMPLE_RATE:.1f}秒")
             
-            try:
-                text = await transcribe_chunk(segment)
-                if text:
-                    buffer.add_text(text)
-                    full_text = buffer.get_full_text()
-                    await websocket.send(json.dumps({
-                        "type": "partial",
-                        "text": full_text,
-                        "is_final": False
-                    }))
-                    logger.info(f"✅ 段: {text}")
-                    logger.info(f"📝 累积: {full_text}")
-            finally:
-                transcribing = False
+            text = await transcribe_chunk(segment)
+            if text:
+                buffer.add_text(text)
+                full_text = buffer.get_full_text()
+                await websocket.send(to_json({
+                    "type": "partial",
+                    "text": full_text,
+                    "is_final": False
+                }))
+                logger.info(f"✅ 段: {text}")
+                logger.info(f"📝 累积: {full_text}")
 
 async def handle_streaming_client(websocket, path):
     """处理流式客户端连接"""
@@ -192,7 +529,7 @@ async def handle_streaming_client(websocket, path):
     transcribe_task = None
     
     try:
-        await websocket.send(json.dumps({
+        await websocket.send(to_json({
             "type": "connected",
             "message": "已连接到 SenseVoice STT 服务",
             "mode": "streaming"
@@ -208,35 +545,35 @@ async def handle_streaming_client(websocket, path):
             
             elif isinstance(message, str):
                 try:
-                    data = json.loads(message)
+                    data = orjson.loads(message)
                     cmd = data.get("command")
                     
                     if cmd == "start":
+                        buffer.decoder.close()
                         buffer = AudioBuffer()
                         session_active = True
                         
                         transcribe_task = asyncio.create_task(
-                            periodic_transcribe(buffer, websocket, interval=0.5)
+                            periodic_transcribe(buffer, websocket)
                         )
                         
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "session_started"
                         }))
                         logger.info(f"✅ 开始新会话")
                     
                     elif cmd == "stop":
+                        # 不能直接取消：正在转录的语音段已从缓冲区取出，取消就丢了
                         if transcribe_task:
-                            transcribe_task.cancel()
-                            try:
-                                await transcribe_task
-                            except asyncio.CancelledError:
-                                pass
+                            buffer.stop_transcribing()
+                            await transcribe_task
                         
-                        # 处理剩余数据
+                        # 等解码线程处理完已收到的数据，再取剩余部分
+                        await asyncio.get_running_loop().run_in_executor(None, buffer.close)
                         remaining = buffer.get_remaining_data()
-                        if remaining and len(remaining) > 10240:
-                            logger.info(f"🔄 最后一段 {len(remaining)} 字节")
-                            text = await transcribe_chunk(remaining)
+                        if remaining is not None and len(remaining) > SAMPLE_RATE * 0.3:
+                            logger.info(f"🔄 最后一段 {len(remaining) / SAMPLE_RATE:.1f}秒")
+                            text = await transcribe_final(remaining)
                             if text:
                                 buffer.add_text(text)
                                 logger.info(f"✅ 段: {text}")
@@ -245,24 +582,24 @@ async def handle_streaming_client(websocket, path):
                         full_text = buffer.get_full_text()
                         logger.info(f"📝 完整: {full_text}")
                         
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "final",
                             "text": full_text,
                             "is_final": True
                         }))
                         
                         session_active = False
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "session_ended"
                         }))
                         logger.info(f"✅ 结束")
                     
                     elif cmd == "ping":
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "pong"
                         }))
                     
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     logger.warning(f"⚠️ 无效 JSON: {e}")
     
     except websockets.exceptions.ConnectionClosed:
@@ -273,6 +610,8 @@ async def handle_streaming_client(websocket, path):
         logger.error(f"处理客户端 {client_id} 时出错: {e}", exc_info=True)
         if transcribe_task:
             transcribe_task.cancel()
+    finally:
+        buffer.decoder.close()
 
 async def main():
     """启动服务"""
@@ -5,32 +5,205 @@
 """
 import asyncio
 import websockets
-import json
-import tempfile
+import orjson
 import os
+import io
 import wave
 import logging
-from faster_whisper import WhisperModel
+import time
+import threading
+from pathlib import Path
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import av
+import numpy as np
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from batching import BatchQueue
 try:
     from opencc import OpenCC
     HAS_OPENCC = True
 except ImportError:
     HAS_OPENCC = False
 
+try:
+    import onnxruntime as ort
+    from onnxruntime_extensions import get_library_path
+    HAS_ORT = True
+except ImportError:
+    HAS_ORT = False
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 模型输入采样率
+SAMPLE_RATE = 16000
+# 能量 VAD：20ms 一帧，帧 RMS 低于阈值算静音，连续静音 500ms 判定停顿
+VAD_FRAME = 320
+SILENCE_RMS = 0.01
+MIN_SILENCE_FRAMES = 25
+# 一直不停顿时最长 30 秒强制切一段（Whisper 一个窗口的长度）
+MAX_SEGMENT_SAMPLES = 30 * SAMPLE_RATE
+# 强制切分时保留最后 5 秒作为下一段的上下文，切断的词在下一段里完整出现
+CONTEXT_TAIL_SAMPLES = 5 * SAMPLE_RATE
+# 上下文重复转录出的文本，最多回看已确认文本的最后 50 个字来对齐
+MAX_OVERLAP_CHARS = 50
+# 对齐时允许替换已确认文本结尾几个字（强制切分处被切断、识别错的字）
+MAX_TAIL_FIX_CHARS = 2
+
 # 繁体转简体转换器
 CC = None
 
-# 全局模型
+# 全局模型（FasterWhisperBackend 或 ONNXWhisperBackend）
 MODEL = None
+EXECUTOR = None  # 转录线程池，不阻塞事件循环
+BATCHER = None  # 所有会话待转录的段在这里合批
+
+# 模型名：tiny, base, small, medium, large-v3（可用环境变量覆盖）
+# distil-* 模型只支持英文，中文流式默认用 small int8，比 medium 快 2-3 倍
+MODEL_NAME = os.getenv("STT_MODEL", "small")
+# 预先量化好的本地模型目录（见 README），存在时直接加载，省去启动时的量化
+MODELS_DIR = Path(__file__).parent / "models"
+# 并发转录数：每个 worker 是共享权重的独立 CTranslate2 副本
+NUM_WORKERS = int(os.getenv("STT_NUM_WORKERS", 2))
+# 每个 worker 的线程数，默认把核数平分给各 worker，避免超订
+CPU_THREADS = int(os.getenv("STT_CPU_THREADS", max(1, (os.cpu_count() or 2) // NUM_WORKERS)))
+# 合批：最多几段一起推理，第一段到达后最多再等多久凑批
+BATCH_MAX = int(os.getenv("STT_BATCH_SIZE", 4))
+BATCH_WAIT = 0.05
+# 推理后端：faster-whisper（CTranslate2）或 onnx（ONNX Runtime，Olive 导出的 int8 整图）
+BACKEND = os.getenv("STT_BACKEND", "faster-whisper")
+ONNX_MODEL = os.getenv("STT_ONNX_MODEL", str(MODELS_DIR / "whisper_cpu_int8_cpu-cpu_model.onnx"))
+# Whisper 多语言词表（v1/v2）的解码前缀：<|startoftranscript|> <|语言|> <|transcribe|> <|notimestamps|>
+LANGUAGE_TOKENS = {"en": 50259, "zh": 50260}
+
+def resolve_model(name: str, compute_type: str) -> str:
+    """优先使用 models/whisper-<name>-<compute_type>，否则按模型名下载"""
+    local = MODELS_DIR / f"whisper-{name}-{compute_type}"
+    return str(local) if local.is_dir() else name
+
+def to_wav(audio: np.ndarray) -> bytes:
+    """float32 PCM 封装成内存中的 16-bit WAV"""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(SAMPLE_RATE)
+        wf.writeframes((np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+    return buf.getvalue()
+
+class FasterWhisperBackend:
+    """CTranslate2 后端（faster-whisper），推理时释放 GIL"""
+    def __init__(self):
+        self.model = WhisperModel(
+            resolve_model(MODEL_NAME, "int8"),
+            device="cpu",
+            compute_type="int8",
+            cpu_threads=CPU_THREADS,
+            num_workers=NUM_WORKERS
+        )
+        self.pipeline = BatchedInferencePipeline(model=self.model)
+    
+    def transcribe_batch(self, audios: list, language: str) -> list:
+        """同步批量转录，返回每段的文本
+        
+        各段拼成一条音频，用 clip_timestamps 标出每段位置（超过 30 秒的再切开），
+        编码器一次前向算完整批；每个片段输出一个 segment，按 seek 对回原来的段。
+        我们自己已按停顿切段，clip_timestamps 下不再跑 faster-whisper 的 VAD。
+        """
+        clips = []
+        owners = {}  # seek（帧号）-> 段下标
+        start = 0
+        for k, audio in enumerate(audios):
+            if len(audio) < SAMPLE_RATE // 10:
+                start += len(audio)  # 太短，不值得推理
+                continue
+            for i in range(0, len(audio), MAX_SEGMENT_SAMPLES):
+                end = min(i + MAX_SEGMENT_SAMPLES, len(audio))
+                if i > 0 and end - i < SAMPLE_RATE // 10:
+                    break  # 切剩的尾巴太短，补零到 30 秒窗口后容易幻觉
+                clips.append({"start": start + i, "end": start + end})
+                owners[int((start + i) / SAMPLE_RATE * self.model.frames_per_second)] = k
+            start += len(audio)
+        
+        parts = [[] for _ in audios]
+        if not clips:
+            return [""] * len(audios)
+        
+        segments, info = self.pipeline.transcribe(
+            np.concatenate(audios),
+            language=language,
+            beam_size=1,  # 贪心解码，分段已由我们拼接，中文准确率几乎不变，速度约 3 倍
+            best_of=1,
+            temperature=0,
+            condition_on_previous_text=False,  # 短段上容易重复/幻觉
+            without_timestamps=True,  # 只用文本，不生成时间戳 token
+            clip_timestamps=clips,
+            batch_size=len(clips)
+        )
+        
+        # 收集结果
+        for segment in segments:
+            if segment.no_speech_prob > 0.6 and segment.avg_logprob < -1.0:
+                continue  # 静音上的幻觉
+            parts[owners[segment.seek]].append(segment.text)
+        
+        return ["".join(p) for p in parts]
+
+class ONNXWhisperBackend:
+    """ONNX Runtime 后端：Olive 导出的 Whisper int8 模型
+    
+    整图包含音频解码、特征提取、beam search 和分词器，
+    输入是音频文件字节，输出直接是文本；InferenceSession.run 可多线程并发调用。
+    """
+    def __init__(self, model_path: str):
+        options = ort.SessionOptions()
+        options.register_custom_ops_library(get_library_path())  # 前后处理算子
+        options.intra_op_num_threads = CPU_THREADS
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+    
+    def transcribe(self, audio: np.ndarray, language: str) -> str:
+        """同步转录"""
+        inputs = {
+            "audio_stream": np.frombuffer(to_wav(audio), dtype=np.uint8)[np.newaxis, :],
+            "max_length": np.array([200], dtype=np.int32),
+            "min_length": np.array([0], dtype=np.int32),
+            "num_beams": np.array([1], dtype=np.int32),  # 贪心解码，与 faster-whisper 后端一致
+            "num_return_sequences": np.array([1], dtype=np.int32),
+            "length_penalty": np.array([1.0], dtype=np.float32),
+            "repetition_penalty": np.array([1.0], dtype=np.float32),
+        }
+        if "decoder_input_ids" in self.input_names:
+            # 多语言模型：固定语言和任务，不做语种检测
+            inputs["decoder_input_ids"] = np.array(
+                [[50258, LANGUAGE_TOKENS[language], 50359, 50363]], dtype=np.int32
+            )
+        return str(self.session.run(None, inputs)[0][0][0])
+    
+    def transcribe_batch(self, audios: list, language: str) -> list:
+        """同步批量转录（整图按单条音频导出，逐段推理）"""
+        return [self.transcribe(audio, language) for audio in audios]
 
 def init_model():
     """初始化 Whisper 模型"""
-    global MODEL, CC
-    logger.info("正在加载 Whisper 模型 (medium)...")
-    MODEL = WhisperModel("medium", device="cpu", compute_type="int8")
+    global MODEL, CC, EXECUTOR, BATCHER
+    if BACKEND == "onnx":
+        if not HAS_ORT:
+            logger.error("未安装 onnxruntime，请运行: pip install onnxruntime onnxruntime-extensions")
+            raise ImportError("onnxruntime not installed")
+        logger.info(f"正在加载 ONNX Whisper 模型 ({ONNX_MODEL}, {NUM_WORKERS} x {CPU_THREADS} 线程)...")
+        MODEL = ONNXWhisperBackend(ONNX_MODEL)
+    else:
+        logger.info(f"正在加载 Whisper 模型 ({MODEL_NAME}, {NUM_WORKERS} x {CPU_THREADS} 线程)...")
+        MODEL = FasterWhisperBackend()
+    EXECUTOR = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+    BATCHER = BatchQueue(MODEL.transcribe_batch, EXECUTOR, BATCH_MAX, BATCH_WAIT, NUM_WORKERS)
     logger.info("模型加载完成")
     
     # 初始化繁简转换
@@ -40,67 +213,336 @@ def init_model():
     else:
         logger.warning("未安装 opencc-python-reimplemented，无法进行繁简转换")
         logger.warning("安装命令: pip install opencc-python-reimplemented")
+    
+    warm_up()
+
+def _frame_energy(pcm, frame):
+    """每帧 RMS（逐样本累加平方，numba 下自动向量化）"""
+    n = len(pcm) // frame
+    energy = np.empty(n, dtype=np.float32)
+    for i in range(n):
+        acc = 0.0
+        for j in range(i * frame, (i + 1) * frame):
+            acc += pcm[j] * pcm[j]
+        energy[i] = np.sqrt(acc / frame)
+    return energy
+
+def _scan_silence(energy, threshold, min_frames, run, voiced):
+    """扫描帧能量，找"说过话之后连续 min_frames 帧静音"的位置
+    
+    run / voiced 是跨调用保留的状态（当前连续静音帧数、本段是否已有语音），
+    返回 (最后一个切分帧下标，没有则 -1, run, voiced)
+    """
+    cut = -1
+    for i in range(len(energy)):
+        if energy[i] >= threshold:
+            run = 0
+            voiced = True
+        else:
+            run += 1
+            if voiced and run >= min_frames:
+                cut = i
+                voiced = False
+    return cut, run, voiced
+
+if HAS_NUMBA:
+    frame_energy = njit(cache=True, fastmath=True)(_frame_energy)
+    scan_silence = njit(cache=True)(_scan_silence)
+else:
+    def frame_energy(pcm, frame):
+        """每帧 RMS（没有 numba 时用 numpy 整块计算）"""
+        n = len(pcm) // frame
+        frames = pcm[:n * frame].reshape(n, frame)
+        return np.sqrt(np.mean(np.square(frames), axis=1))
+    
+    # 每秒只有 50 帧，纯 Python 扫描也足够快
+    scan_silence = _scan_silence
+
+def is_silence(audio: np.ndarray) -> bool:
+    """没有一帧能量达到 VAD 阈值（客户端停发超时、stop 时切出的段可能整段静音）"""
+    energy = frame_energy(audio, VAD_FRAME)
+    return len(energy) == 0 or float(energy.max()) < SILENCE_RMS
+
+class StreamDecoder:
+    """流式解码器，后台线程把 webm/opus 字节流解码为 16kHz 单声道 float32
+    
+    MediaRecorder 只有第一个分片带容器头，后续分片无法单独解码，
+    所以整个会话共用一个解码器，按到达顺序喂入数据。
+    """
+    def __init__(self, on_pcm):
+        self.on_pcm = on_pcm
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = None
+    
+    def feed(self, data: bytes):
+        """喂入一个音频分片"""
+        with self.cond:
+            if self.closed:
+                return
+            self.pending.append(data)
+            self.cond.notify()
+        
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+    
+    def read(self, size=-1):
+        """供 PyAV 调用的阻塞读取，关闭且读完后返回 b"" 表示结束"""
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if not self.pending:
+                return b""
+            data = self.pending.popleft()
+            if 0 <= size < len(data):
+                self.pending.appendleft(data[size:])
+                data = data[:size]
+            return data
+    
+    def close(self):
+        """结束输入，解码线程处理完剩余数据后退出"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+    
+    def join(self):
+        """等待解码线程结束"""
+        if self.thread:
+            self.thread.join()
+    
+    def _run(self):
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+        try:
+            with av.open(self) as container:
+                for frame in container.decode(audio=0):
+                    for out in resampler.resample(frame):
+                        self.on_pcm(out.to_ndarray().reshape(-1))
+            # 冲刷重采样器中残留的样本
+            for out in resampler.resample(None):
+                self.on_pcm(out.to_ndarray().reshape(-1))
+        except Exception as e:
+            logger.error(f"音频流解码错误: {e}")
+            with self.cond:
+                self.closed = True
+                self.pending.clear()
+
+def warm_up():
+    """启动时用 1 秒静音走一遍解码、VAD 和推理
+    
+    PyAV 首次打开容器、numba 编译、CTranslate2 首次推理（选 GEMM 实现、
+    换入模型权重页）都要几秒，放到启动时做，第一个用户不用等。
+    """
+    start = time.monotonic()
+    chunks = []
+    decoder = StreamDecoder(chunks.append)
+    decoder.feed(to_wav(np.zeros(SAMPLE_RATE, dtype=np.float32)))
+    decoder.close()
+    decoder.join()
+    pcm = np.concatenate(chunks) if chunks else np.zeros(SAMPLE_RATE, dtype=np.float32)
+    
+    scan_silence(frame_energy(pcm, VAD_FRAME), SILENCE_RMS, MIN_SILENCE_FRAMES, 0, False)
+    MODEL.transcribe_batch([pcm], "zh")
+    logger.info(f"预热完成 ({time.monotonic() - start:.1f}秒)")
 
 class AudioBuffer:
-    """音频缓冲区，分段转录"""
+    """音频缓冲区，分段转录
+    
+    字节流经 StreamDecoder 解码为 PCM，能量 VAD 在 PCM 上找停顿，
+    说完一句（连续静音 500ms）就切出一段送去转录。
+    """
     def __init__(self):
-        self.buffer = bytearray()  # 当前段的音频数据
-        self.all_text = []  # 保存所有转录结果
+        self.decoder = StreamDecoder(self._on_pcm)
+        self.loop = asyncio.get_running_loop()
+        self.segment_ready = asyncio.Event()  # 检测到停顿时置位
+        self.lock = threading.Lock()  # 解码线程与事件循环共享下面的状态
+        self.pcm = np.zeros(30 * SAMPLE_RATE, dtype=np.float32)  # 预分配的 PCM 缓冲，整个会话复用
+        self.head = 0  # 当前段在 pcm 中的起点
+        self.num_samples = 0  # 已缓冲样本数
+        self.vad_rest = np.zeros(0, dtype=np.float32)  # 不足一帧的尾巴
+        self.vad_samples = 0  # 已做过 VAD 的样本数
+        self.silent_frames = 0  # 当前连续静音帧数
+        self.voiced = False  # 本段切分点之后是否出现过语音
+        self.cut = None  # 停顿处的样本位置，之前的数据可以转录
+        self.forced = False  # cut 是否为连续说话过长的强制切分
+        self.context = 0  # 当前段开头为上一段保留的上下文样本数
+        self.all_text = ""  # 已完成段落的累积文本
         self.last_data_time = None  # 上次收到数据的时间
-        self.min_data_size = 30 * 1024  # 最小 30KB 才开始转录
-        self.silence_threshold = 1.0  # 静音阈值（秒）
+        self.min_samples = SAMPLE_RATE  # 最少 1 秒才开始转录
+        self.silence_threshold = 1.0  # 客户端停发数据的超时（秒）
+        self.stopping = False  # 收到 stop 后切段任务不再等待，处理完当前段就退出
         
     def add_data(self, data: bytes):
         """添加音频数据"""
-        import time
-        self.buffer.extend(data)
-        self.last_data_time = time.time()
-        
-    def should_transcribe(self):
-        """是否应该转录（检测停顿）"""
-        import time
+        self.decoder.feed(data)
+        self.last_data_time = time.monotonic()
+    
+    def stop_segmenting(self):
+        """通知切段任务退出"""
+        self.stopping = True
+        self.segment_ready.set()
+    
+    def close(self):
+        """结束输入并等待解码完成（阻塞，需在线程池中调用）"""
+        self.decoder.close()
+        self.decoder.join()
+    
+    def _on_pcm(self, pcm: np.ndarray):
+        """解码线程回调：保存 PCM 并跑能量 VAD"""
+        data = np.concatenate([self.vad_rest, pcm]) if len(self.vad_rest) else pcm
+        energy = frame_energy(data, VAD_FRAME)
+        self.vad_rest = data[len(energy) * VAD_FRAME:]
         
-        # 数据太少，不转录
-        if len(self.buffer) < self.min_data_size:
-            return False
+        with self.lock:
+            self._append(pcm)
+            
+            cut, self.silent_frames, self.voiced = scan_silence(
+                energy, SILENCE_RMS, MIN_SILENCE_FRAMES, self.silent_frames, self.voiced
+            )
+            if cut >= 0:
+                # 切在静音帧末尾，位置相对当前段起点
+                self.cut = self.vad_samples + (cut + 1) * VAD_FRAME
+                self.forced = False
+                self._notify()
+            self.vad_samples += len(energy) * VAD_FRAME
+            
+            if self.cut is None:
+                if self.num_samples >= MAX_SEGMENT_SAMPLES:
+                    # 连续说话过长，正好在 30 秒处强制切一段
+                    self.cut = MAX_SEGMENT_SAMPLES
+                    self.forced = True
+                    self._notify()
+                elif not self.voiced and self.num_samples > SAMPLE_RATE:
+                    # 没有语音时只保留最近 1 秒，其余静音丢弃
+                    self._drop(self.num_samples - SAMPLE_RATE)
+    
+    def _notify(self):
+        """唤醒切段任务（在解码线程中调用）"""
+        self.loop.call_soon_threadsafe(self.segment_ready.set)
         
-        # 检测停顿
-        if self.last_data_time:
-            silence_duration = time.time() - self.last_data_time
-            if silence_duration >= self.silence_threshold:
-                logger.info(f"🔇 停顿 {silence_duration:.1f}秒")
+    def should_transcribe(self):
+        """是否应该转录（PCM 上检测到停顿，或客户端停发数据）"""
+        with self.lock:
+            if self.num_samples < self.min_samples:
+                return False
+            
+            if self.cut is not None:
+                if self.forced:
+                    logger.info(f"✂️ 连续说话，强制切出 {self.cut / SAMPLE_RATE:.1f}秒")
+                else:
+                    logger.info(f"🔇 停顿，切出 {self.cut / SAMPLE_RATE:.1f}秒")
                 return True
+            
+            # 检测停顿
+            if self.last_data_time:
+                silence_duration = time.monotonic() - self.last_data_time
+                if silence_duration >= self.silence_threshold:
+                    logger.info(f"🔇 停顿 {silence_duration:.1f}秒")
+                    self.cut = self.num_samples
+                    self.forced = False
+                    return True
         
         return False
     
+    def _append(self, pcm: np.ndarray):
+        """追加 PCM，空间不够时先把有效数据挪到开头，仍不够再翻倍扩容（持锁调用）"""
+        if self.head + self.num_samples + len(pcm) > len(self.pcm):
+            size = len(self.pcm)
+            while size < self.num_samples + len(pcm):
+                size *= 2
+            grown = self.pcm if size == len(self.pcm) else np.empty(size, dtype=np.float32)
+            grown[:self.num_samples] = self.pcm[self.head:self.head + self.num_samples]
+            self.pcm = grown
+            self.head = 0
+        tail = self.head + self.num_samples
+        self.pcm[tail:tail + len(pcm)] = pcm
+        self.num_samples += len(pcm)
+    
+    def _drop(self, k):
+        """丢弃开头 k 个样本，只移动起点不拷贝（持锁调用）"""
+        self.head += k
+        self.num_samples -= k
+        self.vad_samples = max(0, self.vad_samples - k)
+    
+    def _take(self, end):
+        """取出 end 之前的 PCM 副本，剩余部分留作下一段（持锁调用）
+        
+        返回 (PCM, 开头与上一段重叠部分占的比例)
+        """
+        end = min(end, self.num_samples)
+        chunk = self.pcm[self.head:self.head + end].copy()
+        overlap = min(self.context, end) / end if end else 0.0
+        # 强制切分的段把结尾留给下一段当上下文
+        keep = min(CONTEXT_TAIL_SAMPLES, end // 2) if self.forced else 0
+        self._drop(end - keep)
+        self.context = keep
+        self.forced = False
+        self.cut = None
+        return chunk, overlap
+    
     def get_segment_for_transcribe(self):
-        """获取当前段数据并清空（分段转录）"""
-        if len(self.buffer) == 0:
-            return None
-        chunk = bytes(self.buffer)
-        self.buffer.clear()  # 清空，准备下一段
-        return chunk
+        """获取停顿前的一段数据（分段转录），返回 (PCM, 开头重叠比例)"""
+        with self.lock:
+            if self.num_samples == 0:
+                return None, 0.0
+            return self._take(self.cut if self.cut is not None else self.num_samples)
     
     def has_data(self):
         """是否有数据"""
-        return len(self.buffer) > 0
+        return self.num_samples > 0
     
     def get_remaining_data(self):
-        """获取剩余数据"""
-        if len(self.buffer) == 0:
-            return None
-        chunk = bytes(self.buffer)
-        self.buffer.clear()
-        return chunk
-    
-    def add_text(self, text: str):
-        """添加转录结果"""
-        if text:
-            self.all_text.append(text)
+        """获取剩余数据，返回 (PCM, 开头重叠比例)"""
+        with self.lock:
+            if self.num_samples == 0:
+                return None, 0.0
+            return self._take(self.num_samples)
+    
+    def add_text(self, text: str, overlap=0.0):
+        """添加转录结果（只在段落结束时拼接一次）
+        
+        overlap 是这段开头上一段已转录过的音频占比，按它估出重复的字数。
+        在新结果的重复部分里找一段正好接在已确认文本末尾的文字（最多替换结尾
+        MAX_TAIL_FIX_CHARS 个被切断的字），长度不短于估计字数的一半，才从它
+        后面接上；对不上时只去掉已确认文本结尾与新结果开头完全相同的部分，
+        其余照原样追加，宁可重复几个字也不凭估计删掉没确认过的文字。
+        """
+        if not text:
+            return
+        if overlap > 0:
+            context_chars = round(len(text) * overlap)
+            min_chars = max(3, context_chars // 2)
+            tail = self.all_text[-MAX_OVERLAP_CHARS:]
+            for n in range(min(len(tail), len(text)), min_chars - 1, -1):
+                for k in range(min(context_chars, len(text) - n) + 1):
+                    for fix in range(min(MAX_TAIL_FIX_CHARS, len(tail) - n) + 1):
+                        if tail[:len(tail) - fix].endswith(text[k:k + n]):
+                            self.all_text = self.all_text[:len(self.all_text) - fix] + text[k + n:]
+                            return
+            for n in range(min(len(tail), len(text)), 1, -1):
+                if tail.endswith(text[:n]):
+                    text = text[n:]
+                    break
+        self.all_text += text
     
     def get_full_text(self):
-        """获取完整转录结果"""
-        return "".join(self.all_text)
+        """获取完整转录结果，不再每次重新 join 整个列表"""
+        return self.all_text
+
+def to_json(data: dict) -> str:
+    """序列化消息（orjson 返回 bytes，转成 str 才会按文本帧发送）"""
+    return orjson.dumps(data).decode()
+
+# 固定内容的控制消息只序列化一次
+MSG_CONNECTED = to_json({
+    "type": "connected",
+    "message": "已连接到流式 STT 服务",
+    "mode": "streaming"
+})
+MSG_SESSION_STARTED = to_json({"type": "session_started"})
+MSG_SESSION_ENDED = to_json({"type": "session_ended"})
+MSG_PONG = to_json({"type": "pong"})
 
 def to_simplified_chinese(text: str) -> str:
     """转换为简体中文"""
@@ -115,35 +557,17 @@ def to_simplified_chinese(text: str) -> str:
             return text
     return text
 
-async def transcribe_chunk(audio_data: bytes, language="zh"):
-    """转录音频块（支持任意格式）"""
+async def transcribe_chunk(audio: np.ndarray, language="zh"):
+    """转录音频块（16kHz 单声道 float32 PCM）"""
+    if is_silence(audio):
+        logger.info(f"🔇 静音 {len(audio) / SAMPLE_RATE:.1f}秒，跳过转录")
+        return None
+    
     try:
-        # 保存临时文件（让 faster-whisper 自动处理格式）
-        with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as tmp:
-            tmp.write(audio_data)
-            tmp_path = tmp.name
-        
-        logger.info(f"开始转录 {len(audio_data)} 字节的音频数据")
-        
-        # 转录（faster-whisper 内部会用 ffmpeg 转换格式）
-        segments, info = MODEL.transcribe(
-            tmp_path,
-            language=language,
-            beam_size=5,  # 提高准确率
-            vad_filter=True,
-            vad_parameters=dict(
-                min_silence_duration_ms=300,
-                threshold=0.3  # 降低 VAD 阈值，减少过滤
-            )
-        )
-        
-        # 收集结果
-        text = ""
-        for segment in segments:
-            text += segment.text
+        logger.info(f"开始转录 {len(audio) / SAMPLE_RATE:.1f}秒")
         
-        # 删除临时文件
-        os.unlink(tmp_path)
+        # 和其他会话的段一起推理
+        text = await BATCHER.submit(audio, language)
         
         # 转换为简体中文
         text = text.strip()
@@ -156,35 +580,40 @@ async def transcribe_chunk(audio_data: bytes, language="zh"):
         logger.error(f"转录错误: {e}", exc_info=True)
         return None
 
-async def periodic_transcribe(buffer, websocket, interval=0.5):
-    """定时检查任务 - 检测停顿后分段转录"""
-    transcribing = False
-    
-    while True:
-        await asyncio.sleep(interval)
-        
-        if transcribing:
-            continue
+async def periodic_transcribe(buffer, queue):
+    """切段任务 - 等 VAD 通知（检测到停顿）或超时（客户端停发数据），切出一段放进队列（生产者）"""
+    while not buffer.stopping:
+        try:
+            await asyncio.wait_for(buffer.segment_ready.wait(), timeout=buffer.silence_threshold)
+        except asyncio.TimeoutError:
+            pass
+        buffer.segment_ready.clear()
         
-        if buffer.should_transcribe():
-            transcribing = True
+        while buffer.should_transcribe():
             segment = buffer.get_segment_for_transcribe()
-            logger.info(f"🎙️ 转录段 {len(segment)} 字节")
-            
-            try:
-                text = await transcribe_chunk(segment)
-                if text:
-                    buffer.add_text(text)
-                    full_text = buffer.get_full_text()
-                    await websocket.send(json.dumps({
-                        "type": "partial",
-                        "text": full_text,
-                        "is_final": False
-                    }))
-                    logger.info(f"✅ 段: {text}")
-                    logger.info(f"📝 累积: {full_text}")
-            finally:
-                transcribing = False
+            logger.info(f"🎙️ 切出段 {len(segment[0]) / SAMPLE_RATE:.1f}秒")
+            if queue.full():
+                logger.warning(f"⚠️ 转录积压 {queue.qsize()} 段，等待")
+            await queue.put(segment)
+
+async def consume_segments(buffer, queue, websocket):
+    """转录任务 - 按顺序转录队列中的段并推送累积结果（消费者）"""
+    while True:
+        segment, overlap = await queue.get()
+        try:
+            text = await transcribe_chunk(segment)
+            if text:
+                buffer.add_text(text, overlap)
+                full_text = buffer.get_full_text()
+                await websocket.send(to_json({
+                    "type": "partial",
+                    "text": full_text,
+                    "is_final": False
+                }))
+                logger.info(f"✅ 段: {text}")
+                logger.info(f"📝 累积: {full_text}")
+        finally:
+            queue.task_done()
 
 async def handle_streaming_client(websocket, path):
     """处理流式客户端连接"""
@@ -194,13 +623,10 @@ async def handle_streaming_client(websocket, path):
     buffer = AudioBuffer()
     session_active = False
     transcribe_task = None
+    consume_task = None
     
     try:
-        await websocket.send(json.dumps({
-            "type": "connected",
-            "message": "已连接到流式 STT 服务",
-            "mode": "streaming"
-        }))
+        await websocket.send(MSG_CONNECTED)
         
         async for message in websocket:
             if isinstance(message, bytes):
@@ -214,78 +640,95 @@ async def handle_streaming_client(websocket, path):
             elif isinstance(message, str):
                 # 接收控制命令
                 try:
-                    data = json.loads(message)
-                    cmd = data.get("command")
+                    data = orjson.loads(message)
+                    cmd = data.get("command") if isinstance(data, dict) else None
                     
                     if cmd == "start":
                         # 开始新会话
+                        for task in (transcribe_task, consume_task):
+                            if task:
+                                task.cancel()
+                        buffer.decoder.close()
                         buffer = AudioBuffer()
                         session_active = True
                         
-                        # 启动定时转录任务
+                        # 启动切段任务和转录任务：切段不等转录，上一段转录时下一段照常检测
+                        queue = asyncio.Queue(maxsize=2)
                         transcribe_task = asyncio.create_task(
-                            periodic_transcribe(buffer, websocket, interval=3.0)
+                            periodic_transcribe(buffer, queue)
+                        )
+                        consume_task = asyncio.create_task(
+                            consume_segments(buffer, queue, websocket)
                         )
                         
-                        await websocket.send(json.dumps({
-                            "type": "session_started"
-                        }))
+                        await websocket.send(MSG_SESSION_STARTED)
                         logger.info(f"✅ 开始新会话")
                     
                     elif cmd == "stop":
-                        # 停止定时任务
+                        # 停止切段任务，等已切出的段转录完；
+                        # 不能直接取消切段任务：它可能正卡在 put 一段已从缓冲区取出的数据
                         if transcribe_task:
-                            transcribe_task.cancel()
-                            try:
-                                await transcribe_task
-                            except asyncio.CancelledError:
-                                pass
+                            buffer.stop_segmenting()
+                            await asyncio.wait(
+                                {transcribe_task, consume_task}, return_when=asyncio.FIRST_COMPLETED
+                            )
+                            # 转录任务出错退出（如推送时连接断开）时，队列永远等不空
+                            drained = asyncio.create_task(queue.join())
+                            await asyncio.wait(
+                                {drained, consume_task}, return_when=asyncio.FIRST_COMPLETED
+                            )
+                            for task in (drained, transcribe_task, consume_task):
+                                task.cancel()
+                            if consume_task.done() and not consume_task.cancelled() and consume_task.exception():
+                                raise consume_task.exception()
                         
-                        # 处理剩余数据
-                        remaining = buffer.get_remaining_data()
-                        if remaining and len(remaining) > 10240:
-                            logger.info(f"🔄 最后一段 {len(remaining)} 字节")
+                        # 等解码线程处理完已收到的数据，再取剩余部分
+                        await asyncio.get_running_loop().run_in_executor(None, buffer.close)
+                        remaining, overlap = buffer.get_remaining_data()
+                        if remaining is not None and len(remaining) > SAMPLE_RATE * 0.3:
+                            logger.info(f"🔄 最后一段 {len(remaining) / SAMPLE_RATE:.1f}秒")
                             text = await transcribe_chunk(remaining)
                             if text:
-                                buffer.add_text(text)
+                                buffer.add_text(text, overlap)
                                 logger.info(f"✅ 段: {text}")
                         
                         # 返回完整结果
                         full_text = buffer.get_full_text()
                         logger.info(f"📝 完整: {full_text}")
                         
-                        await websocket.send(json.dumps({
+                        await websocket.send(to_json({
                             "type": "final",
                             "text": full_text,
                             "is_final": True
                         }))
                         
                         session_active = False
-                        await websocket.send(json.dumps({
-                            "type": "session_ended"
-                        }))
+                        await websocket.send(MSG_SESSION_ENDED)
                         logger.info(f"✅ 结束")
                     
                     elif cmd == "ping":
-                        await websocket.send(json.dumps({
-                            "type": "pong"
-                        }))
+                        await websocket.send(MSG_PONG)
                     
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     logger.warning(f"⚠️ 无效 JSON: {e}")
     
     except websockets.exceptions.ConnectionClosed:
         logger.info(f"客户端 {client_id} 断开连接")
-        if transcribe_task:
-            transcribe_task.cancel()
+        for task in (transcribe_task, consume_task):
+            if task:
+                task.cancel()
     except Exception as e:
         logger.error(f"处理客户端 {client_id} 时出错: {e}", exc_info=True)
-        if transcribe_task:
-            transcribe_task.cancel()
+        for task in (transcribe_task, consume_task):
+            if task:
+                task.cancel()
+    finally:
+        buffer.decoder.close()
 
 async def main():
     """启动服务"""
     init_model()
+    BATCHER.start()
     
     host = "0.0.0.0"
     port = 8765
@@ -293,7 +736,8 @@ async def main():
     logger.info(f"启动流式 WebSocket 服务器: ws://{host}:{port}")
     logger.info("支持实时流式转录")
     
-    async with websockets.serve(handle_streaming_client, host, port):
+    # 消息都很短，permessage-deflate 压缩的 CPU 开销比省下的流量更大
+    async with websockets.serve(handle_streaming_client, host, port, compression=None):
         await asyncio.Future()
 
 if __name__ == "__main__":